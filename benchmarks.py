@@ -0,0 +1,293 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+"""
+Sked benchmarks.
+
+Compares the record formats used to store pages: the old pickle + zlib
+records against the packed pages stored as is, compressed with zlib and
+with the preset dictionary (the built in one and another trained on the
+corpus itself). Pages are read from Sked XML files given in the command
+line (the output of "Export as XML"), or from the help pages.
+
+Also measures, for each sync policy, the time taken by a page save after
+each keystroke and by the final sync, which writes whatever was deferred,
+and the time taken to format a large page (all the pages joined) with the
+markup module and with the older code, one regular expression for each
+format. The text tags are applied only if there is a display. Database
+scans are timed reading every record by its key, with a single cursor (as
+done by older versions) and with the batched scans of pairs() and keys().
+
+Usage: python benchmarks.py [file.xml ...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import re
+import zlib
+import cPickle
+from xml.dom import minidom
+
+from libsked import records
+from libsked import markup
+
+
+def load_pages(fnames):
+    pages = [ ]
+    for fname in fnames:
+        doc = minidom.parse(fname)
+        for entry in doc.getElementsByTagName("entry"):
+            text = u"".join([ node.data for node in entry.childNodes
+                if node.nodeType == node.TEXT_NODE ])
+            pages.append((entry.getAttribute("name"), text, 0))
+    return pages
+
+
+def run(label, encode, decode, values, repeat):
+    encoded = [ encode(v) for v in values ]
+    start = time.time()
+    for i in range(repeat):
+        for v in values:
+            encode(v)
+    enc_time = time.time() - start
+    start = time.time()
+    for i in range(repeat):
+        for rec in encoded:
+            decode(rec)
+    dec_time = time.time() - start
+    size = sum([ len(rec) for rec in encoded ])
+    count = len(values) * repeat
+    print "%-28s %10d %10.1f %10.1f" % (label, size,
+        enc_time * 1e6 / count, dec_time * 1e6 / count)
+
+
+def legacy_encode(value):
+    return zlib.compress(cPickle.dumps(value, 2))
+
+def legacy_decode(rec):
+    return cPickle.loads(zlib.decompress(rec))
+
+
+_LEGACY_FORMATS = [
+    (ur"^\s*(=+)(.+?)(=+)\s*$", re.MULTILINE, None),
+    (ur"\W(\*+)([^*\n\r]+?)(\*+)\W", 0, "bold"),
+    (ur"\W(//+)([^/\n\r]+?)(//+)\W", 0, "italic"),
+    (ur"\W(_+)([^_\n\r]+?)(_+)\W", 0, "underline"),
+    (ur"(\[\[ *)(.+?)( *\]\])", 0, "link"),
+    (ur"(([a-zA-Z]+://|www\.)[^\s<>\"'\[\]]+[^\s>\"'\)\[\].,;?!]+)", 0, "url"),
+    (ur"(\|\|\|)(.+?)(\|\|\|)", re.MULTILINE | re.DOTALL, "code"),
+    (ur"([0-3]?[0-9])\/([01]?[0-9])\/([0-9]{1,4})", 0, "datelink"),
+    (ur"([0-9]{1,4})-([01]?[0-9])-([0-3]?[0-9])", 0, "datelink"),
+]
+
+def legacy_lex(text, exists):
+    # The old formatting, with a pass for each format; gives the spans in
+    # the order they were applied.
+    spans = [ ]
+    for regex, flags, tag in _LEGACY_FORMATS:
+        for match in re.finditer(regex, text, flags):
+            if tag == "url":
+                spans.append((match.start(), match.end(), tag))
+                continue
+            if tag == "datelink":
+                if exists(match.group()):
+                    spans.append((match.start(), match.end(), tag))
+                else:
+                    spans.append((match.start(), match.end(), "newdatelink"))
+                continue
+            mtag = tag
+            if tag == None:
+                level = len(match.group(1))
+                if level != len(match.group(3)) or level > 3:
+                    continue
+                mtag = "h%d" % (4 - level)
+            elif tag == "link" and not exists(match.group(2)):
+                mtag = "newlink"
+            spans.append((match.start(1), match.end(1), "format"))
+            spans.append((match.start(2), match.end(2), mtag))
+            spans.append((match.start(3), match.end(3), "format"))
+    return spans
+
+def legacy_apply(buf, spans, exists):
+    for start, end, tag in spans:
+        buf.apply_tag_by_name(tag, buf.get_iter_at_offset(start),
+            buf.get_iter_at_offset(end))
+
+
+def formatting(pages, size = 500000, repeat = 5):
+    # Tags are applied only if PyGTK is available and there is a display.
+    apply_spans = None
+    try:
+        from libsked import sked
+        buf = sked.gtk.TextBuffer()
+        apply_spans = lambda buf, spans, exists: \
+            sked.apply_spans(buf, sked.tag_spans(spans, exists))
+    except (ImportError, RuntimeError):
+        pass
+    names = set([ p[0] for p in pages ])
+    exists = names.__contains__
+    text = u"\n".join([ p[1] for p in pages ])
+    text = text * (size / len(text) + 1)
+    print "%-28s %10s %10s %10s" % ("Formatting", "Spans", "Parse ms",
+        "Tags ms")
+    for label, parse, apply in (
+    ("multi-pass (old)", lambda t: legacy_lex(t, exists), legacy_apply),
+    ("single pass", markup.parse, apply_spans)):
+        start = time.time()
+        for i in range(repeat):
+            spans = parse(text)
+        parse_time = (time.time() - start) / repeat
+        if apply_spans != None:
+            buf = sked.gtk.TextBuffer()
+            for tag in ("format", "h1", "h2", "h3", "bold", "italic",
+            "underline", "link", "newlink", "url", "code", "datelink",
+            "newdatelink"):
+                buf.create_tag(tag)
+            buf.set_text(text)
+            start = time.time()
+            apply(buf, spans, exists)
+            print "%-28s %10d %10.1f %10.1f" % (label, len(spans),
+                parse_time * 1e3, (time.time() - start) * 1e3)
+        else:
+            print "%-28s %10d %10.1f %10s" % (label, len(spans),
+                parse_time * 1e3, "-")
+
+
+def sync_policies(keystrokes = 500):
+    from libsked import database
+    from libsked import pages
+    edb = database.EncryptedDatabase
+    print "%-28s %10s %10s" % ("Sync policy", "Save us", "Final ms")
+    for policy in edb.SYNC_POLICIES:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = edb(os.path.join(tmpdir, "bench.db"), sync_policy = policy)
+            db.get_lock()
+            db.create(u"")
+            db.sync_interval = 1
+            pm = pages.PageManager(db)
+            page = pages.Page(u"Benchmark", u"")
+            start = time.time()
+            for i in range(keystrokes):
+                page.text += u"abcdefgh "[i % 9]
+                page.cursor_pos = len(page.text)
+                pm.save(page)
+            save_time = time.time() - start
+            start = time.time()
+            db.sync(True)
+            final_time = time.time() - start
+            db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        print "%-28s %10.1f %10.1f" % (policy, save_time * 1e6 / keystrokes,
+            final_time * 1e3)
+
+
+def scans(pages, count = 5000, repeat = 5):
+    from libsked import database
+    edb = database.EncryptedDatabase
+    texts = [ p[1] for p in pages ]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = edb(os.path.join(tmpdir, "bench.db"))
+        db.get_lock()
+        db.create(u"")
+        with db.batch():
+            for i in range(count):
+                db.set_key("page:%06d" % i, records.PageRecord(u"%d" % i,
+                    texts[i % len(texts)], 0))
+        db.sync(True)
+
+        def by_key():
+            for key in list(db.keys("page:")):
+                db.get_key(key)
+
+        def single_cursor():
+            cursor = db._db.cursor(db._txn)
+            try:
+                rec = cursor.set_range("page:")
+                while rec != None and rec[0].startswith("page:"):
+                    records.decode(rec[1])
+                    rec = cursor.next()
+            finally:
+                cursor.close()
+
+        def keys_full_read():
+            cursor = db._db.cursor(db._txn)
+            try:
+                rec = cursor.set_range("page:")
+                while rec != None and rec[0].startswith("page:"):
+                    rec = cursor.next()
+            finally:
+                cursor.close()
+
+        print "%-28s %10s %10s" % ("Scan of %d records" % count, "Total ms",
+            "Record us")
+        for label, func in (
+        ("get_key for each key", by_key),
+        ("single cursor (old)", single_cursor),
+        ("pairs(), batched", lambda: list(db.pairs("page:"))),
+        ("keys, full records", keys_full_read),
+        ("keys(), partial reads", lambda: list(db.keys("page:")))):
+            start = time.time()
+            for i in range(repeat):
+                func()
+            elapsed = (time.time() - start) / repeat
+            print "%-28s %10.1f %10.1f" % (label, elapsed * 1e3,
+                elapsed * 1e6 / count)
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(args):
+    fnames = args or [ "libsked/help.xml" ]
+    pages = load_pages(fnames)
+    if len(pages) == 0:
+        print "No pages found."
+        return
+    repeat = max(1, 20000 / len(pages))
+    print "%d pages, %d characters." % (len(pages),
+        sum([ len(p[1]) for p in pages ]))
+    print
+    print "%-28s %10s %10s %10s" % ("Format", "Bytes", "Encode us",
+        "Decode us")
+
+    run("pickle + zlib (old)", legacy_encode, legacy_decode, pages, repeat)
+    recs = [ records.PageRecord(*p) for p in pages ]
+    for level in (0, 1, 6, 9):
+        run("packed, dictionary, level %d" % level,
+            lambda v: records.encode(v, level), records.decode, recs, repeat)
+
+    # Variants not used by the database, for comparison.
+    payloads = [ records.encode(r, 0)[1:] for r in recs ]
+    run("packed + zlib", zlib.compress, zlib.decompress, payloads, repeat)
+    trained = records.PresetDictionary(records.train_dictionary(
+        [ p[1] for p in pages ]))
+    run("packed, trained dictionary", trained.compress, trained.decompress,
+        payloads, repeat)
+
+    print
+    small = [ 0, 1234, True, u"Index", (12, 34), "#ff0000", 1271539200 ]
+    run("small values, old", legacy_encode, legacy_decode, small, 20000)
+    run("small values, new", records.encode, records.decode, small, 20000)
+
+    print
+    formatting(pages)
+
+    print
+    try:
+        import bsddb
+    except ImportError:
+        print "Berkeley DB not available, skipping the database benchmarks."
+        return
+    sync_policies()
+    print
+    scans(pages)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
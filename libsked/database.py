@@ -26,13 +26,16 @@ Databases used by Sked.
 
 from bsddb import db
 import os
-import zlib
-import cPickle as pickle
+import time
 import hashlib
 import random
+import contextlib
+import threading
+import Queue
 from pathlock import any_lock_system
 
 import utils
+import records
 
 
 class NotReadyError(Exception):
@@ -88,13 +91,86 @@ class EncryptedDatabase(object):
     """Implements a Sked secure database over a Berkeley DB4.x encrypted 
     database. Key MUST be a valid Unicode string, data may be any python
     object.
+
+    The database is opened in a transactional environment kept in the
+    directory 'path' + ".env", holding the write-ahead log. Writes done
+    with 'sync' = False are grouped in a transaction which is committed
+    by the next 'sync' call, so every sync just flushes the log instead
+    of the whole database file. The log is also used to recover the
+    database after a crash. Writes may also be grouped in batches, which
+    are applied atomically (see 'begin_batch').
+
+    New databases are B-trees, whose keys are kept sorted, so the keys
+    with a given prefix or in a given range are found without scanning
+    the whole database. Hash databases, created by older versions, are
+    still supported and may be converted with 'convert'.
+
+    Values are stored in the formats defined by the module 'records'.
     TODO: Implement automatic database verification if the new path
     locking system says us that it is necessary.
     """
 
-    def __init__(self, path):
+    # Durability policies for committed transactions: flush the log to
+    # the disk (survives system crashes), write the log to the operating
+    # system without flushing it (survives application crashes) or just
+    # keep it in memory (only the atomicity of the commits is ensured).
+    DURABILITY_SYNC = 1
+    DURABILITY_WRITE_NOSYNC = 2
+    DURABILITY_NOSYNC = 3
+
+    # Policies for 'sync': make the writes durable at once, at most every
+    # 'sync_interval' seconds, or only when asked by 'sync(True)' (which
+    # applications call when idle or before quitting). Deferred writes are
+    # still committed, but the log is not flushed.
+    SYNC_ALWAYS = "always"
+    SYNC_INTERVAL = "interval"
+    SYNC_ON_IDLE = "on-idle"
+    SYNC_ON_QUIT = "on-quit"
+    SYNC_POLICIES = (SYNC_ALWAYS, SYNC_INTERVAL, SYNC_ON_IDLE, SYNC_ON_QUIT)
+
+    # Writes grouped before a commit is forced, even without a sync, to
+    # bound the number of locks held by the transaction. Batches are never
+    # split.
+    MAX_GROUP_WRITES = 1000
+
+    # The database file is checkpointed (written from the cache and the
+    # log files no longer needed removed) when these many KB were logged
+    # or minutes passed since the last checkpoint.
+    CHECKPOINT_KBYTES = 1024
+    CHECKPOINT_MINUTES = 5
+
+    # Access methods.
+    ACCESS_HASH = db.DB_HASH
+    ACCESS_BTREE = db.DB_BTREE
+
+    # Bytes read by a cursor before it is closed, when scanning the
+    # database. The records are still fetched one by one.
+    BULK_READ_SIZE = 1024 * 1024
+
+    # Zlib level used to compress the records (0 to store them as is).
+    compression_level = records.DEFAULT_LEVEL
+
+    _CACHE_SIZE = 4 * 1024 * 1024
+    _MAX_LOCKS = 100000
+
+    # Seconds between syncs for the policy SYNC_INTERVAL.
+    sync_interval = 30
+
+    def __init__(self, path, durability = DURABILITY_SYNC,
+    sync_policy = SYNC_ALWAYS):
         self._db = None
+        self._env = None
+        self._txn = None
+        self._txn_writes = 0
+        self._batch_level = 0
+        self._access = None
+        self._durability = durability
+        self._sync_policy = None
+        self.sync_policy = sync_policy
+        self._dirty = False
+        self._last_sync = 0
         self._path = os.path.realpath(path)
+        self._env_path = self._path + ".env"
         ddir = os.path.split(self._path)[0]
         if not os.path.exists(ddir):
             os.makedirs(ddir, 0700)
@@ -114,45 +190,98 @@ class EncryptedDatabase(object):
     def is_ready(self):
         return self._ready
 
+    def get_durability(self):
+        return self._durability
+
+    def set_durability(self, durability):
+        """ Sets the durability policy for the commits, one of the constants
+        DURABILITY_*. """
+        self._durability = durability
+        if self._env != None:
+            self._set_env_durability()
+
+    durability = property(get_durability, set_durability)
+
+    def get_sync_policy(self):
+        return self._sync_policy
+
+    def set_sync_policy(self, policy):
+        """ Sets when 'sync' makes the writes durable, one of the constants
+        SYNC_*. """
+        if policy not in EncryptedDatabase.SYNC_POLICIES:
+            raise ValueError("Invalid sync policy %r" % policy)
+        self._sync_policy = policy
+
+    sync_policy = property(get_sync_policy, set_sync_policy)
+
+    @property
+    def is_dirty(self):
+        """ True if there are writes not made durable yet. """
+        return self._dirty
+
+    @property
+    def access_method(self):
+        """ Returns the access method of the open database, ACCESS_HASH or
+        ACCESS_BTREE. """
+        return self._access
+
+    @property
+    def is_sorted(self):
+        """ True if the keys are kept sorted (ie. the database is a B-tree)
+        and range scans are cheap. """
+        return self._access == EncryptedDatabase.ACCESS_BTREE
+
     def try_open(self, pwd):
         try:
-            self._db = db.DB()
             enckey = make_key(pwd)
-            self._db.set_encrypt(enckey, db.DB_ENCRYPT_AES)
-            self._db.open(self._path, None, db.DB_HASH, db.DB_DIRTY_READ)
+            self._check_key(enckey)
+            self._open(enckey, db.DB_DIRTY_READ, db.DB_UNKNOWN)
             self._set_pwd_hash(pwd)
             self._ready = True
             return True
         except:
-            pass
+            self._abort_open()
         return False
     
-    def create(self, pwd):
-        self._db = db.DB()
-        enckey = make_key(pwd)
-        self._db.set_encrypt(enckey, db.DB_ENCRYPT_AES)
-        self._db.open(self._path, None, db.DB_HASH, db.DB_CREATE)
+    def create(self, pwd, access = ACCESS_BTREE):
+        # Any log left by a database with this name is useless now.
+        _remove_env_dir(self._env_path)
+        self._open(make_key(pwd), db.DB_CREATE, access)
         self._set_pwd_hash(pwd)
         self._ready = True
 
     def change_pwd(self, newpwd):
         # Creates a new database and re-encrypts everything.
+        return self._rebuild(newpwd, self._access)
+
+    def convert(self, pwd, access):
+        """ Rebuilds the database with the given access method. 'pwd' must
+        be the current password. """
+        if not self.check_password(pwd):
+            raise ValueError("Wrong password")
+        return self._rebuild(pwd, access)
+
+    def _rebuild(self, newpwd, access):
+        # Copies all records to a new database and replaces this one.
         # FIXME: There is a race condition here.
         newpath = self._path + str(random.random()) + ".tmp"
         while os.path.exists(newpath):
             newpath = self._path + str(random.random()) + ".tmp"
 
         newdb = EncryptedDatabase(newpath)
-        newdb.create(newpwd)
+        newdb.create(newpwd, access)
         
-        cursor = self._db.cursor()
-        rec = cursor.first()
-        while rec:
-            newdb._db.put(rec[0], rec[1])
-            rec = cursor.next()
+        for key, val in self._raw_pairs():
+            newdb._db.put(key, val, txn=newdb._write_txn())
         
-        newdb.close()
-        self._db.close()
+        newdb._close()
+        self._close()
+
+        # The logs are encrypted with the old password, so both
+        # environments must go. Their databases were checkpointed when
+        # closed, so nothing is lost.
+        _remove_env_dir(newdb._env_path)
+        _remove_env_dir(self._env_path)
 
         # DB4 provides its own rename. Why?  May it save us from the lack 
         # of atomicity on Windows' os.rename()?
@@ -161,10 +290,8 @@ class EncryptedDatabase(object):
 
 
     def close(self):
-        self._db.close()
-        self._db = None
+        self._close()
         self.release_lock()
-        self._ready = False
 
     def get_lock(self):
         """Try to get exclusive access to the database."""
@@ -184,54 +311,289 @@ class EncryptedDatabase(object):
     def has_key(self, key):
         if not self._ready:
             raise NotReadyError
-        return self._db.has_key(key) == 1
+        return self._db.has_key(key, self._txn) == 1
     
     def set_key(self, key, value, sync = True):
+        self.set_record(key, records.encode(value, self.compression_level),
+            sync)
+
+    def set_record(self, key, record, sync = True):
+        """ Stores a record already encoded by 'records.encode'. """
         if not self._ready:
             raise NotReadyError
-        self._db.put(key, zlib.compress(pickle.dumps(value, 2)))
+        self._db.put(key, record, txn=self._write_txn())
         if sync:
             self.sync()
 
-    def sync(self):
-        """ Writes all cached data to the disk. It is not perfect: we should
-        be using DB transactions too.
-        """
-        self._db.sync()
+    def begin_batch(self):
+        """ Starts a batch: all writes until the matching 'commit' are
+        applied atomically, with a single log flush, and any sync requested
+        meanwhile is deferred to the commit. Batches may be nested; only
+        the outermost one is committed. """
+        if not self._ready:
+            raise NotReadyError
+        if self._batch_level == 0 and self._txn != None:
+            # Keeps previous writes out of the batch, so 'abort' does not
+            # discard them.
+            self._commit(db.DB_TXN_NOSYNC)
+        self._batch_level += 1
+
+    def commit(self):
+        """ Ends a batch started by 'begin_batch'. """
+        if self._batch_level > 0:
+            self._batch_level -= 1
+            if self._batch_level == 0:
+                self.sync()
+
+    def abort(self):
+        """ Discards all writes done since the outermost batch was started
+        and ends it. """
+        if self._batch_level > 0:
+            self._batch_level = 0
+            if self._txn != None:
+                txn = self._txn
+                self._txn = None
+                self._txn_writes = 0
+                txn.abort()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Context manager running its block in a batch, which is aborted
+        if an exception is raised. """
+        self.begin_batch()
+        try:
+            yield self
+        except:
+            self.abort()
+            raise
+        self.commit()
+
+    def sync(self, force = False):
+        """ Commits all pending writes and, if the sync policy allows (or
+        'force' is True), makes them durable according to the durability
+        policy and checkpoints the database if needed. Does nothing inside
+        a batch. """
+        if not self._dirty or self._batch_level > 0:
+            return
+        if force or self._sync_due():
+            if self._txn != None:
+                self._commit()
+            elif self._durability != EncryptedDatabase.DURABILITY_NOSYNC:
+                # Only commits without flushing were done.
+                self._env.log_flush()
+            self._dirty = False
+            self._last_sync = time.time()
+            self._env.txn_checkpoint(EncryptedDatabase.CHECKPOINT_KBYTES,
+                EncryptedDatabase.CHECKPOINT_MINUTES)
+            self._env.log_archive(db.DB_ARCH_REMOVE)
+        elif self._txn != None:
+            self._commit(db.DB_TXN_NOSYNC)
 
     def get_key(self, key, default = None):
         if not self._ready:
             raise NotReadyError
         try:
-            val = self._db.get(key)
+            val = self._db.get(key, txn=self._txn)
             if val != None:
-                return pickle.loads(zlib.decompress(val))
+                return records.decode(val)
         except db.DBNotFoundError:
             pass
         return default
 
     def del_key(self, key):
-        if self._db.has_key(key) == 1:
-            self._db.delete(key)
+        if self._db.has_key(key, self._txn) == 1:
+            self._db.delete(key, txn=self._write_txn())
 
-    def pairs(self):
+    def pairs(self, prefix = None, start = None, end = None):
+        """ Iterates over the (key, value) pairs of the database. If given,
+        only keys starting with 'prefix' and within the interval ['start',
+        'end') are returned. Keys are sorted in B-tree databases. """
         if not self._ready:
             raise NotReadyError
-        cursor = self._db.cursor()
-        rec = cursor.first()
-        while rec:
-            data = pickle.loads(zlib.decompress(rec[1]))
-            yield rec[0], data
-            rec = cursor.next()
-
-    def keys(self):
+        for key, val in self._raw_pairs(prefix, start, end):
+            yield key, records.decode(val)
+
+    def keys(self, prefix = None, start = None, end = None):
+        """ Iterates over the keys of the database, filtered as in
+        'pairs'. """
         if not self._ready:
             raise NotReadyError
-        cursor = self._db.cursor()
-        rec = cursor.first()
-        while rec:
-            yield rec[0]
-            rec = cursor.next()
+        if self._access != EncryptedDatabase.ACCESS_BTREE:
+            keys = [ key for key in self._db.keys(self._txn)
+                if _key_in_range(key, prefix, start, end) ]
+        else:
+            # Partial reads (dlen = 0) skip the data.
+            keys, done = self._scan(prefix, start, end, keys_only=True)
+        for key in keys:
+            yield key
+
+    def get_key_async(self, key, default = None):
+        """ Returns a finished Future for the value of 'key', so callers may
+        use the same code with an AsyncDatabase. """
+        future = Future()
+        try:
+            future._set(self.get_key(key, default), None)
+        except Exception, e:
+            future._set(None, e)
+        return future
+
+    def run(self, func, *args):
+        """ Returns 'func(self, *args)'. See AsyncDatabase.run. """
+        return func(self, *args)
+
+    def run_later(self, func, *args):
+        """ Calls 'func(self, *args)'. See AsyncDatabase.run_later. """
+        func(self, *args)
+
+    def _raw_pairs(self, prefix = None, start = None, end = None):
+        # Yields the (key, raw data) pairs in the range, read by a cursor
+        # in batches of about BULK_READ_SIZE bytes. No cursor is kept open
+        # between batches, so the caller may write (and commit) while
+        # iterating.
+        if self._access != EncryptedDatabase.ACCESS_BTREE:
+            # Hashes can not be resumed from a key; everything is read by
+            # a single call.
+            for key, val in self._db.items(self._txn):
+                if _key_in_range(key, prefix, start, end):
+                    yield key, val
+            return
+        after = None
+        done = False
+        while not done:
+            recs, done = self._scan(prefix, start, end, after,
+                EncryptedDatabase.BULK_READ_SIZE)
+            for rec in recs:
+                yield rec
+            if len(recs) > 0:
+                after = recs[-1][0]
+
+    def _scan(self, prefix, start, end, after = None, limit = None,
+    keys_only = False):
+        # Reads the records of a B-tree in the range, in key order, starting
+        # after the key 'after' (if given) and up to about 'limit' bytes of
+        # data. Returns a list of records (or keys, if 'keys_only') and True
+        # if the end of the range was reached.
+        low = max(prefix or "", start or "", after or "")
+        recs = [ ]
+        size = 0
+        # Partial reads only for the keys: bsddb takes dlen and doff both
+        # or none of them.
+        if keys_only:
+            kw = { "dlen": 0, "doff": 0 }
+        else:
+            kw = { }
+        cursor = self._db.cursor(self._txn)
+        try:
+            try:
+                if low == "":
+                    rec = cursor.first(**kw)
+                else:
+                    rec = cursor.set_range(low, **kw)
+                if rec != None and rec[0] == after:
+                    rec = cursor.next(**kw)
+                while rec != None:
+                    key = rec[0]
+                    if (prefix != None and not key.startswith(prefix)) \
+                    or (end != None and key >= end):
+                        break
+                    if limit != None and size >= limit:
+                        return recs, False
+                    if keys_only:
+                        recs.append(key)
+                    else:
+                        recs.append(rec)
+                        size += len(key) + len(rec[1])
+                    rec = cursor.next(**kw)
+            except db.DBNotFoundError:
+                pass
+        finally:
+            cursor.close()
+        return recs, True
+
+    def _open(self, enckey, flags, access):
+        if not os.path.exists(self._env_path):
+            os.makedirs(self._env_path, 0700)
+        fresh_env = len(_log_files(self._env_path)) == 0
+        self._env = db.DBEnv()
+        self._env.set_encrypt(enckey, db.DB_ENCRYPT_AES)
+        self._env.set_cachesize(0, EncryptedDatabase._CACHE_SIZE)
+        self._env.set_lk_max_locks(EncryptedDatabase._MAX_LOCKS)
+        self._env.set_lk_max_objects(EncryptedDatabase._MAX_LOCKS)
+        self._set_env_durability()
+        self._env.open(self._env_path, db.DB_CREATE | db.DB_PRIVATE
+            | db.DB_RECOVER | db.DB_INIT_TXN | db.DB_INIT_LOG
+            | db.DB_INIT_LOCK | db.DB_INIT_MPOOL | db.DB_THREAD, 0600)
+        if fresh_env and os.path.exists(self._path):
+            # The pages of databases coming from other environments (or
+            # created without one) may refer to log records we do not have.
+            self._env.lsn_reset(self._path, db.DB_ENCRYPT)
+        self._db = db.DB(self._env)
+        self._db.set_flags(db.DB_ENCRYPT)
+        self._db.open(self._path, dbtype=access,
+            flags=flags | db.DB_AUTO_COMMIT | db.DB_THREAD, mode=0600)
+        self._access = self._db.get_type()
+
+    def _abort_open(self):
+        # Releases the handles left by a failed open.
+        for handle in (self._db, self._env):
+            if handle != None:
+                try:
+                    handle.close()
+                except:
+                    pass
+        self._db = None
+        self._env = None
+
+    def _check_key(self, enckey):
+        # Opens the database file outside the environment to check the
+        # password, so the recovery never runs with a wrong key.
+        tdb = db.DB()
+        tdb.set_encrypt(enckey, db.DB_ENCRYPT_AES)
+        tdb.open(self._path, None, db.DB_UNKNOWN, db.DB_RDONLY)
+        tdb.close()
+
+    def _close(self):
+        self.abort()
+        if self._txn != None:
+            self._commit()
+        self._db.close()
+        self._db = None
+        self._env.txn_checkpoint(0, 0, db.DB_FORCE)
+        self._env.log_archive(db.DB_ARCH_REMOVE)
+        self._env.close()
+        self._env = None
+        self._dirty = False
+        self._ready = False
+
+    def _set_env_durability(self):
+        self._env.set_flags(db.DB_TXN_WRITE_NOSYNC,
+            self._durability == EncryptedDatabase.DURABILITY_WRITE_NOSYNC)
+        self._env.set_flags(db.DB_TXN_NOSYNC,
+            self._durability == EncryptedDatabase.DURABILITY_NOSYNC)
+
+    def _write_txn(self):
+        # Returns the transaction grouping the writes, committing it first
+        # if it has grown too much.
+        if self._txn_writes >= EncryptedDatabase.MAX_GROUP_WRITES \
+        and self._batch_level == 0:
+            self._commit(db.DB_TXN_NOSYNC)
+        if self._txn == None:
+            self._txn = self._env.txn_begin()
+        self._txn_writes += 1
+        self._dirty = True
+        return self._txn
+
+    def _sync_due(self):
+        policy = self._sync_policy
+        return policy == EncryptedDatabase.SYNC_ALWAYS \
+            or (policy == EncryptedDatabase.SYNC_INTERVAL
+                and time.time() - self._last_sync >= self.sync_interval)
+
+    def _commit(self, flags = 0):
+        txn = self._txn
+        self._txn = None
+        self._txn_writes = 0
+        txn.commit(flags)
 
     def _make_pwd_hash(self, pwd):
         if not self._pwd_salt:
@@ -249,3 +611,313 @@ class EncryptedDatabase(object):
         self._pwd_salt = None   # Resets the salt.
         self._pwd_hash = self._make_pwd_hash(pwd)
 
+class Future(object):
+    """ Result of an operation run by the worker thread of an
+    AsyncDatabase. """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = [ ]
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.isSet()
+
+    def result(self, timeout = None):
+        """ Waits for the operation and returns its result, raising the
+        exception it raised, if any. """
+        if not self._event.wait(timeout) and not self._event.isSet():
+            raise RuntimeError("Timed out waiting for the database")
+        if self._error != None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, func):
+        """ Calls 'func' with this future when the operation finishes. It
+        may be called from the worker thread: GUI code must hand the result
+        over to the main loop (eg. with 'gobject.idle_add'). """
+        with self._lock:
+            if not self._event.isSet():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _set(self, result, error):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = [ ]
+        for func in callbacks:
+            func(self)
+
+
+class AsyncDatabase(object):
+    """ Runs all operations of an EncryptedDatabase in a worker thread, so
+    the caller never waits for the disk on writes. Values are encoded by
+    the caller and queued; until written they are kept in a pending table,
+    from where they are returned by reads. Reads of other keys are run by
+    the worker ahead of the queued writes; the caller waits for them, or
+    gets a Future from 'get_key_async'. Key scans, batches, functions
+    given to 'run' and any other attribute of the database are run in
+    order with the writes.
+
+    The write queue is bounded: when it is full, writers wait. Errors of
+    queued writes are raised by the next call to 'flush', 'sync' or any
+    write. 'close' writes everything and closes the database.
+    """
+
+    # Maximum number of writes waiting in the queue.
+    MAX_PENDING_WRITES = 1000
+
+    _READ = 0
+    _WRITE = 1
+    _DELETED = object()
+
+    def __init__(self, db):
+        self._db = db
+        self._queue = Queue.PriorityQueue()
+        self._slots = threading.BoundedSemaphore(
+            AsyncDatabase.MAX_PENDING_WRITES)
+        self._lock = threading.Lock()
+        self._pending = { }
+        self._serial = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+            name="Sked database")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    @property
+    def database(self):
+        """ Returns the wrapped database. """
+        return self._db
+
+    def get_durability(self):
+        return self._db.durability
+
+    def set_durability(self, durability):
+        self._submit(AsyncDatabase._WRITE, self._db.set_durability,
+            (durability,)).result()
+
+    durability = property(get_durability, set_durability)
+
+    def get_sync_policy(self):
+        return self._db.sync_policy
+
+    def set_sync_policy(self, policy):
+        self._submit(AsyncDatabase._WRITE, setattr,
+            (self._db, "sync_policy", policy)).result()
+
+    sync_policy = property(get_sync_policy, set_sync_policy)
+
+    def get_sync_interval(self):
+        return self._db.sync_interval
+
+    def set_sync_interval(self, interval):
+        self._submit(AsyncDatabase._WRITE, setattr,
+            (self._db, "sync_interval", interval)).result()
+
+    sync_interval = property(get_sync_interval, set_sync_interval)
+
+    def __getattr__(self, name):
+        # Anything else (properties, password changes, etc.) is passed to
+        # the database, calls being run by the worker after the queued
+        # writes.
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            return self._submit(AsyncDatabase._WRITE, attr, args,
+                kwargs).result()
+        return call
+
+    def has_key(self, key):
+        found, record = self._get_pending(key)
+        if found:
+            return record is not AsyncDatabase._DELETED
+        return self._submit(AsyncDatabase._READ, self._db.has_key,
+            (key,)).result()
+
+    def get_key(self, key, default = None):
+        return self.get_key_async(key, default).result()
+
+    def get_key_async(self, key, default = None):
+        """ Returns a Future for the value of 'key'. """
+        found, record = self._get_pending(key)
+        if found:
+            future = Future()
+            if record is AsyncDatabase._DELETED:
+                future._set(default, None)
+            else:
+                future._set(records.decode(record), None)
+            return future
+        return self._submit(AsyncDatabase._READ, self._db.get_key,
+            (key, default))
+
+    def set_key(self, key, value, sync = True):
+        self.set_record(key, records.encode(value,
+            self._db.compression_level), sync)
+
+    def set_record(self, key, record, sync = True):
+        self._write(key, record, self._db.set_record, (key, record, sync))
+
+    def del_key(self, key):
+        self._write(key, AsyncDatabase._DELETED, self._db.del_key, (key,))
+
+    def run(self, func, *args):
+        """ Calls 'func(database, *args)' in the worker thread, after the
+        queued writes, and returns its result. 'database' is the wrapped
+        database, which 'func' must use instead of this object, as the
+        worker would wait for itself; several reads and writes are so run
+        without waiting for each one. Its writes skip the pending table:
+        the keys written by 'func' must only be read by other calls. """
+        return self._submit(AsyncDatabase._WRITE, func,
+            (self._db,) + args).result()
+
+    def run_later(self, func, *args):
+        """ Like 'run', but does not wait: errors are raised as the errors
+        of queued writes. """
+        self._write(None, None, func, (self._db,) + args)
+
+    def sync(self, force = False):
+        self._check_error()
+        self._submit(AsyncDatabase._WRITE, self._db.sync, (force,))
+
+    def keys(self, prefix = None, start = None, end = None):
+        return iter(self._submit(AsyncDatabase._WRITE, _list,
+            (self._db.keys, prefix, start, end)).result())
+
+    def pairs(self, prefix = None, start = None, end = None):
+        return iter(self._submit(AsyncDatabase._WRITE, _list,
+            (self._db.pairs, prefix, start, end)).result())
+
+    def begin_batch(self):
+        self._check_error()
+        self._submit(AsyncDatabase._WRITE, self._db.begin_batch, ())
+
+    def commit(self):
+        """ Ends a batch started by 'begin_batch'. Waits for the writes of
+        the batch: if any of them failed, the batch is aborted and the error
+        raised. """
+        self._submit(AsyncDatabase._WRITE, _noop, ()).result()
+        if self._error != None:
+            self.abort()
+            self._check_error()
+        self._submit(AsyncDatabase._WRITE, self._db.commit, ())
+
+    def abort(self):
+        # Waits, so no read may be served by the aborted transaction.
+        self._submit(AsyncDatabase._WRITE, self._db.abort, ()).result()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Context manager running its block in a batch, which is aborted
+        if an exception is raised. """
+        self.begin_batch()
+        try:
+            yield self
+            self.commit()
+        except:
+            self.abort()
+            raise
+
+    def flush(self):
+        """ Waits until all queued operations are done. """
+        self._submit(AsyncDatabase._WRITE, _noop, ()).result()
+        self._check_error()
+
+    def close(self):
+        """ Writes all pending changes, stops the worker thread and closes
+        the database. """
+        try:
+            self.flush()
+        finally:
+            self._submit(AsyncDatabase._WRITE, None, ())
+            self._thread.join()
+            self._db.close()
+
+    def _get_pending(self, key):
+        with self._lock:
+            entry = self._pending.get(key)
+        if entry == None:
+            return False, None
+        return True, entry[1]
+
+    def _write(self, key, record, func, args):
+        self._check_error()
+        # Waits for a free slot before taking the lock: the worker needs
+        # it to release the slots.
+        self._slots.acquire()
+        with self._lock:
+            self._serial += 1
+            serial = self._serial
+            if key != None:
+                self._pending[key] = (serial, record)
+            self._queue.put((AsyncDatabase._WRITE, serial, func, args, { },
+                None, key))
+
+    def _submit(self, priority, func, args, kwargs = { }):
+        future = Future()
+        with self._lock:
+            self._serial += 1
+            self._queue.put((priority, self._serial, func, args, kwargs,
+                future, None))
+        return future
+
+    def _check_error(self):
+        if self._error != None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _run(self):
+        while True:
+            priority, serial, func, args, kwargs, future, key = \
+                self._queue.get()
+            if func == None:
+                break
+            result = error = None
+            try:
+                result = func(*args, **kwargs)
+            except Exception, e:
+                error = e
+            if future != None:
+                future._set(result, error)
+            else:
+                # Queued write: unblocks writers and drops the pending
+                # record, unless it was replaced meanwhile.
+                if error != None and self._error == None:
+                    self._error = error
+                with self._lock:
+                    entry = self._pending.get(key)
+                    if entry != None and entry[0] == serial:
+                        del self._pending[key]
+                self._slots.release()
+
+
+def _list(func, *args):
+    return list(func(*args))
+
+def _noop():
+    pass
+
+
+def _key_in_range(key, prefix, start, end):
+    return (prefix == None or key.startswith(prefix)) \
+        and (start == None or key >= start) \
+        and (end == None or key < end)
+
+def _log_files(env_path):
+    return [ fname for fname in os.listdir(env_path)
+        if fname.startswith("log.") ]
+
+def _remove_env_dir(env_path):
+    # Removes a database environment directory (region and log files).
+    if os.path.isdir(env_path):
+        for fname in os.listdir(env_path):
+            os.remove(os.path.join(env_path, fname))
+        os.rmdir(env_path)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# Sked - a wikish scheduler with Python and PyGTK
+# (c) 2006-10 Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA.
+
+"""
+Edit (Levenshtein) distance functions for similarity searches. Uses the
+module python-levenshtein if available, falling back to a bit-parallel
+implementation in Python, vectorized with NumPy when possible.
+"""
+
+import heapq
+
+HAVE_LEVENSHTEIN = False
+try:
+    import Levenshtein
+    HAVE_LEVENSHTEIN = True
+except: pass
+
+HAVE_NUMPY = False
+try:
+    import numpy
+    HAVE_NUMPY = True
+except: pass
+
+
+def _pattern_bits(pattern):
+    # Maps each char of 'pattern' to a bit mask with its positions.
+    peq = { }
+    for i, c in enumerate(pattern):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    return peq
+
+
+def _myers(peq, m, text):
+    # Myers' bit-parallel algorithm, as formulated by Hyyrö for the edit
+    # distance between the whole strings. The vertical deltas of the
+    # dynamic programming column are kept as the bit vectors 'pv' (+1) and
+    # 'mv' (-1); 'score' tracks the value at the bottom row.
+    if m == 0:
+        return len(text)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv = full
+    mv = 0
+    score = m
+    for c in text:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv
+    return score
+
+
+def myers_distance(a, b):
+    """ Returns the Levenshtein distance between the strings 'a' and 'b'
+    using only Python code. """
+    if len(a) > len(b):
+        a, b = b, a
+    return _myers(_pattern_bits(a), len(a), b)
+
+
+if HAVE_LEVENSHTEIN:
+    distance = Levenshtein.distance
+else:
+    distance = myers_distance
+
+
+class BatchMatcher(object):
+    """ Finds the words nearest to a search term by scoring every word of
+    a set. With NumPy, the bit vectors of all words are updated at once,
+    one column (char position) at a time; the words are kept sorted by
+    length, so the words still being scored at any column are a prefix of
+    the batch. Without NumPy, words are scored one by one, sharing the
+    term bit masks.
+    """
+
+    # NumPy scoring uses 64 bit vectors; longer terms are scored in Python.
+    MAX_NUMPY_TERM = 64
+
+    def __init__(self, words = ()):
+        self._words = set(words)
+        self._batch = None
+
+    def __len__(self):
+        return len(self._words)
+
+    def __contains__(self, word):
+        return word in self._words
+
+    def add(self, word):
+        if word not in self._words:
+            self._words.add(word)
+            self._batch = None
+
+    def remove(self, word):
+        if word in self._words:
+            self._words.remove(word)
+            self._batch = None
+
+    def nearest(self, term, count):
+        """ Returns a list with up to 'count' (distance, word) pairs for the
+        words nearest to 'term', sorted by distance. """
+        if count < 1 or len(self._words) == 0:
+            return [ ]
+        if HAVE_NUMPY and len(term) <= self.MAX_NUMPY_TERM:
+            words, scores = self._numpy_scores(term)
+            pairs = zip(scores.tolist(), words)
+        else:
+            peq = _pattern_bits(term)
+            m = len(term)
+            pairs = [ (_myers(peq, m, word), word) for word in self._words ]
+        return heapq.nsmallest(count, pairs)
+
+    def _numpy_scores(self, term):
+        if self._batch == None:
+            words = sorted(self._words, key=len, reverse=True)
+            # Fixed width Unicode arrays are UCS-4, so the code points of
+            # the chars may be read directly as a matrix.
+            chars = numpy.array(words, dtype=numpy.unicode_)
+            width = max(1, chars.dtype.itemsize // 4)
+            chars = chars.view(numpy.uint32).reshape(len(words), width)
+            lengths = numpy.array([ len(w) for w in words ], numpy.int64)
+            # active[j]: number of words with more than 'j' chars.
+            active = numpy.searchsorted(-lengths, -numpy.arange(width),
+                side="left")
+            self._batch = (words, chars, lengths, active)
+        words, chars, lengths, active = self._batch
+        m = len(term)
+        if m == 0:
+            return words, lengths
+        u64 = numpy.uint64
+        one = u64(1)
+        full = u64((1 << m) - 1)
+        last = u64(1 << (m - 1))
+        peq = [ (ord(c), u64(bits)) for c, bits in
+            _pattern_bits(term).iteritems() ]
+        n = len(words)
+        pv = numpy.empty(n, numpy.uint64)
+        pv.fill(full)
+        mv = numpy.zeros(n, numpy.uint64)
+        score = numpy.empty(n, numpy.int64)
+        score.fill(m)
+        for j in range(chars.shape[1]):
+            k = active[j]
+            if k == 0:
+                break
+            col = chars[:k, j]
+            eq = numpy.zeros(k, numpy.uint64)
+            for code, bits in peq:
+                eq[col == code] |= bits
+            cpv = pv[:k]
+            cmv = mv[:k]
+            xv = eq | cmv
+            xh = (((eq & cpv) + cpv) ^ cpv) | eq
+            ph = cmv | ~(xh | cpv)
+            mh = cpv & xh
+            score[:k] += ((ph & last) != 0).astype(numpy.int64)
+            score[:k] -= ((mh & last) != 0).astype(numpy.int64)
+            ph = (ph << one) | one
+            mh = mh << one
+            pv[:k] = (mh | ~(xv | ph)) & full
+            mv[:k] = ph & xv
+        return words, score
@@ -34,6 +34,7 @@ import re
 import libsked  # For VERSION
 from history import HistoryManager
 from macros import MacroManager
+from database import EncryptedDatabase
 import utils
 import os.path
 
@@ -95,6 +96,7 @@ class PreferencesDialog(BaseDialog):
         self.spHistorySize = self.ui.get_object("spHistorySize")
         self.cbShowEdit = self.ui.get_object("cbShowEdit")
         self.cbShowSidebar = self.ui.get_object("cbShowSidebar")
+        self.cbKeepRevisions = self.ui.get_object("cbKeepRevisions")
         self.clbStandard = self.ui.get_object("clbStandard")
         self.clbHeader1 = self.ui.get_object("clbHeader1")
         self.clbHeader2 = self.ui.get_object("clbHeader2")
@@ -122,6 +124,8 @@ class PreferencesDialog(BaseDialog):
         self.rbOpenLast = self.ui.get_object("rbOpenLast")
         self.rbOpenOther = self.ui.get_object("rbOpenOther")
         self.txOpenPageName = self.ui.get_object("txOpenPageName")
+        self.cbSyncPolicy = self.ui.get_object("cbSyncPolicy")
+        self.spSyncInterval = self.ui.get_object("spSyncInterval")
 
         self.lsMacros = self.ui.get_object("lsMacros")
         self.macro_store = gtk.ListStore(str, str)
@@ -188,6 +192,12 @@ class PreferencesDialog(BaseDialog):
         self.txRedirectPageTemplate.get_buffer().set_text(
             self.parent.DEFAULT_REDIRECT_PAGE_TEMPLATE)
 
+    def on_cbSyncPolicy(self, widget = None, data = None):
+        self.spSyncInterval.set_property("sensitive",
+            self.cbSyncPolicy.get_active() ==
+            EncryptedDatabase.SYNC_POLICIES.index(
+                EncryptedDatabase.SYNC_INTERVAL))
+
     def on_rbStartup(self, widget = None, data = None):
         self.txOpenPageName.set_property("sensitive",
             self.rbOpenOther.get_active())
@@ -200,10 +210,20 @@ class PreferencesDialog(BaseDialog):
     def _set_widget_values(self):
         self.spFormatTime.set_value(self.opt.get_int("format_time"))
         self.spSaveTime.set_value(self.opt.get_int("save_time"))
+        # The combo box lists the sync policies in the same order.
+        policy = self.opt.get_str("sync_policy")
+        if policy in EncryptedDatabase.SYNC_POLICIES:
+            self.cbSyncPolicy.set_active(
+                EncryptedDatabase.SYNC_POLICIES.index(policy))
+        else:
+            self.cbSyncPolicy.set_active(0)
+        self.spSyncInterval.set_value(self.opt.get_int("sync_interval"))
+        self.on_cbSyncPolicy()
         self.spUndoLevels.set_value(self.opt.get_int("undo_levels"))
         self.spHistorySize.set_value(self.opt.get_int("max_history"))
         self.cbShowEdit.set_active(self.opt.get_bool("show_edit_buttons"))
         self.cbShowSidebar.set_active(self.opt.get_bool("show_sidebar"))
+        self.cbKeepRevisions.set_active(self.opt.get_bool("keep_revisions"))
 
         self.clbStandard.set_color(self.opt.get_color("std_color"))
         self.clbHeader1.set_color(self.opt.get_color("header1_color"))
@@ -249,10 +269,15 @@ class PreferencesDialog(BaseDialog):
     def _save_widget_values(self):
         self.opt.set_int("format_time", self.spFormatTime.get_value_as_int())
         self.opt.set_int("save_time", self.spSaveTime.get_value_as_int())
+        self.opt.set_str("sync_policy",
+            EncryptedDatabase.SYNC_POLICIES[self.cbSyncPolicy.get_active()])
+        self.opt.set_int("sync_interval",
+            self.spSyncInterval.get_value_as_int())
         self.opt.set_int("undo_levels", self.spUndoLevels.get_value_as_int())
         self.opt.set_int("max_history", self.spHistorySize.get_value_as_int())
         self.opt.set_bool("show_edit_buttons", self.cbShowEdit.get_active())
         self.opt.set_bool("show_sidebar", self.cbShowSidebar.get_active())
+        self.opt.set_bool("keep_revisions", self.cbKeepRevisions.get_active())
 
         self.opt.set_color("std_color", self.clbStandard.get_color())
         self.opt.set_color("header1_color", self.clbHeader1.get_color())
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# Sked - a wikish scheduler with Python and PyGTK
+# (c) 2006-10 Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA.
+
+"""
+Wiki markup parser.
+
+Finds the markup in the text of a page and returns it as spans, tuples
+(start, end, kind, target) with the character offsets of the marked text,
+its kind (one of the constants below, also the names of the text tags used
+by the interface) and, for links, dates and URLs, their target: the name
+of the linked page (dates are given as YYYY-MM-DD) or the address. It does
+not use GTK, so it may be used without a display.
+"""
+
+import re
+import bisect
+
+from pages import Page
+from utils import LRUCache
+
+
+# Kinds of spans.
+FORMAT = "format"       # The formatting codes themselves
+H1 = "h1"
+H2 = "h2"
+H3 = "h3"
+BOLD = "bold"
+ITALIC = "italic"
+UNDERLINE = "underline"
+CODE = "code"
+LINK = "link"
+URL = "url"
+DATE = "date"
+
+
+# The markup, scanned in a single pass. At each position the alternatives
+# are tried in this order; most of them start with a literal character so
+# the others are skipped quickly. Only code blocks may contain "|||", which
+# keeps them the same as found by _CODE_RE. The text of headings and of the
+# emphasis formats may have other markup, found by scanning it again.
+_MARKUP_RE = re.compile(ur"""
+    \|\|\| ([\s\S]+?) \|\|\|                                # |||code|||
+  | ^\s* (={1,3}) (?!=) ((?:[^\n|]|\|(?!\|\|))+?) (?<!=) \2 \s*$  # == H ==
+  | \[\[[ ]* ((?:[^\n|]|\|(?!\|\|))+?) [ ]*\]\]             # [[Link]]
+  | [a-zA-Z] (?<![a-zA-Z]{2}) (?:[a-zA-Z]*://|(?<=w)ww\.)   # URL
+        [^\s<>"'\[\]|]+ [^\s>"'\)\[\].,;?!|]+
+  | [0-9] (?:(?<=[0-3])[0-9])? / [01]?[0-9] / [0-9]{1,4}    # 31/12/2010
+  | [0-9][0-9]{0,3} - [01]?[0-9] - [0-3]?[0-9]              # 2010-12-31
+  | \* (?<!\w\*) \** ((?:[^*\n\r|]|\|(?!\|\|))+?) \*+ (?!\w)   # *bold*
+  | // (?<!\w//) /* ((?:[^/\n\r|]|\|(?!\|\|))+?) //+ (?!\w)    # //italic//
+  | _ (?<!\w_) _* ((?:[^_\n\r|]|\|(?!\|\|))+?) _+ (?!\w)       # _underline_
+""", re.MULTILINE | re.VERBOSE)
+
+_CODE_RE = re.compile(ur"\|\|\|[\s\S]+?\|\|\|")
+
+_HEADINGS = { 3: H1, 2: H2, 1: H3 }
+
+# Kind of the text between the delimiters, by the first character of the
+# markup, and if that text may have other markup.
+_DELIMITED = {
+    u"|": (CODE, False),
+    u"[": (LINK, False),
+    u"*": (BOLD, True),
+    u"/": (ITALIC, True),
+    u"_": (UNDERLINE, True),
+}
+
+
+def parse(text, pos = 0, endpos = None):
+    """ Returns the spans of the markup between the offsets pos and endpos
+    of 'text', sorted by their starting offsets. Markup inside headings and
+    emphasis follows the span of the enclosing text. """
+    if endpos == None:
+        endpos = len(text)
+    spans = [ ]
+    for match in _MARKUP_RE.finditer(text, pos, endpos):
+        mstart, mend = match.span()
+        first = text[mstart]
+        group = match.lastindex
+        if group == None:
+            if first.isdigit():
+                name = Page.parse_date_name(match.group())[0]
+                spans.append((mstart, mend, DATE, name))
+            else:
+                spans.append((mstart, mend, URL, match.group()))
+            continue
+        start, end = match.span(group)
+        target = None
+        if first in _DELIMITED:
+            kind, inner = _DELIMITED[first]
+            if kind == LINK:
+                target = match.group(group)
+        else:   # Heading, possibly after some blank lines.
+            level = len(match.group(group - 1))
+            kind = _HEADINGS[level]
+            inner = True
+            mstart = start - level
+            mend = end + level
+        spans.append((mstart, start, FORMAT, None))
+        spans.append((start, end, kind, target))
+        if inner:
+            spans.extend(parse(text, start, end))
+        spans.append((end, mend, FORMAT, None))
+    return spans
+
+
+def code_blocks(text, endpos = None):
+    """ Returns the (start, end) offsets of the code blocks starting before
+    endpos. A block is always parsed as a whole, as the "|||" that closes it
+    may be many lines away. """
+    if endpos == None:
+        endpos = len(text)
+    blocks = [ ]
+    for match in _CODE_RE.finditer(text):
+        if match.start() >= endpos:
+            break
+        blocks.append(match.span())
+    return blocks
+
+
+def expand_region(blocks, text, start, end):
+    """ Returns the offsets of the region between start and end grown to
+    whole lines, ending after the last newline, and to whole code blocks
+    ('blocks', as returned by code_blocks). Regions so expanded may be
+    parsed apart, giving the same spans as the whole text. """
+    start = text.rfind(u"\n", 0, start) + 1
+    end = _next_line(text, end)
+    # Blocks do not overlap, so only the last one starting before each end
+    # of the region may cross it.
+    while True:
+        i = bisect.bisect_left(blocks, (start, ))
+        if i == 0 or blocks[i-1][1] <= start:
+            break
+        start = text.rfind(u"\n", 0, blocks[i-1][0]) + 1
+    while True:
+        i = bisect.bisect_left(blocks, (end, ))
+        if i == 0 or blocks[i-1][1] <= end:
+            break
+        end = _next_line(text, blocks[i-1][1])
+    return start, end
+
+def _next_line(text, offset):
+    # Returns the offset of the line after the one at 'offset', unless it
+    # is already the start of a line.
+    if offset >= len(text):
+        return len(text)
+    if offset == 0 or text[offset-1] == u"\n":
+        return offset
+    end = text.find(u"\n", offset)
+    if end < 0:
+        return len(text)
+    return end + 1
+
+
+class SpanCache(LRUCache):
+    """ LRU cache of the spans found in texts, indexed by a hash of the text
+    and bounded by the total number of spans held. Spans may also depend on
+    something else, like the set of existing pages, identified by a version:
+    getting or putting spans for another version clears the cache. """
+
+    def __init__(self, max_spans):
+        LRUCache.__init__(self, max_spans, len)
+        self.version = None
+
+    def get(self, key, version):
+        """ Returns the spans cached for 'key' or None. """
+        self._check_version(version)
+        return LRUCache.get(self, key)
+
+    def put(self, key, spans, version):
+        """ Caches the list 'spans' for 'key', dropping the least recently
+        used ones if needed. The list must not be changed after this. """
+        self._check_version(version)
+        LRUCache.put(self, key, spans)
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.clear()
+            self.version = version
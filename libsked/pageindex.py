@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+# Sked - a wikish scheduler with Python and PyGTK
+# (c) 2006-10 Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA.
+
+"""
+Page indexes used to speed up searches.
+"""
+
+import re
+import heapq
+
+_WORD_RE = re.compile(ur"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """ Returns the set of terms (lowercase Unicode words) found in the
+    given text. """
+    return set(_WORD_RE.findall(text.lower()))
+
+
+class FullTextIndex(object):
+    """ Inverted index mapping the words used in the page names and texts to
+    the normalized names of the pages containing them. Each term has its
+    own record (a set of page names) under the prefix 'ftterm:' and the
+    terms of every page are kept under 'ftpage:', so the postings of a page
+    may be updated without loading its previous text. Changes are cached
+    and only written to the database by 'flush'.
+
+    The index is read and written through the 'run' and 'run_later' calls
+    of the database: with an AsyncDatabase, only its worker thread uses
+    the index, so updating it never waits for the database.
+
+    Search terms are matched as substrings of the indexed words, so the
+    index only narrows the candidate set: callers must still check the
+    pages returned by 'candidates'.
+    """
+
+    _TERM_PREFIX = "ftterm:"
+    _PAGE_PREFIX = "ftpage:"
+    _VERSION_KEY = "ftindex"
+    _VERSION = 1
+
+    # Search tokens found in more terms than this will not narrow the
+    # search; it is cheaper to check all pages than loading every posting.
+    MAX_EXPANSION = 500
+
+    # Number of pages indexed between flushes on rebuilds and batches,
+    # bounding the memory used by cached postings.
+    FLUSH_INTERVAL = 500
+
+    def __init__(self, db):
+        self._db = db
+        self._ready = None
+        self._vocabulary = None
+        self._postings = { }
+        self._dirty = set()
+
+    @property
+    def is_ready(self):
+        """ True if the index was built for this database. """
+        return self._db.run(self._is_ready)
+
+    def reset(self):
+        """ Discards all cached data and changes not flushed yet, so the
+        index is reloaded from the database. """
+        self._db.run_later(self._reset)
+
+    def rebuild(self, pages):
+        """ Discards the current index and indexes all pages given by the
+        iterable 'pages'. """
+        self._db.run_later(self._clear)
+        for count, page in enumerate(pages):
+            self.add_page(page.normalized_name, page.name, page.text)
+            if count % self.FLUSH_INTERVAL == 0:
+                self.flush(False)
+        self.flush(False)
+        self._db.run_later(self._set_version)
+
+    def add_page(self, normname, name, text):
+        """ Indexes (or reindexes) the page 'normname'. """
+        self._db.run_later(self._add_page, normname,
+            tokenize(name) | tokenize(text))
+
+    def remove_page(self, normname):
+        """ Removes the page 'normname' from the index. """
+        self._db.run_later(self._remove_page, normname)
+
+    def flush(self, sync = True):
+        """ Writes the changed postings to the database. """
+        self._db.run_later(self._flush, sync)
+
+    def candidates(self, token):
+        """ Returns the set of normalized names of the pages having a word
+        that contains 'token' (a lowercase Unicode word) or None if the
+        index can not narrow the search for this token. """
+        return self._db.run(self._candidates, token)
+
+    # The methods below are run by the database and use the database
+    # given to them.
+
+    def _is_ready(self, db):
+        if self._ready == None:
+            self._ready = db.get_key(self._VERSION_KEY) == self._VERSION
+        return self._ready
+
+    def _reset(self, db):
+        self._ready = None
+        self._vocabulary = None
+        self._postings = { }
+        self._dirty = set()
+
+    def _clear(self, db):
+        # The index is marked as built by '_set_version' only after all
+        # pages were added, so an interrupted rebuild is done again.
+        db.del_key(self._VERSION_KEY)
+        for prefix in (self._TERM_PREFIX, self._PAGE_PREFIX):
+            for key in list(db.keys(prefix)):
+                db.del_key(key)
+        self._vocabulary = set()
+        self._postings = { }
+        self._dirty = set()
+        self._ready = True
+
+    def _set_version(self, db):
+        db.set_key(self._VERSION_KEY, self._VERSION)
+
+    def _add_page(self, db, normname, terms):
+        if not self._is_ready(db):
+            return
+        old_terms = db.get_key(self._PAGE_PREFIX + normname, set())
+        if terms == old_terms:
+            return
+        for term in old_terms - terms:
+            self._get_postings(db, term).discard(normname)
+            self._dirty.add(term)
+        for term in terms - old_terms:
+            self._get_postings(db, term).add(normname)
+            self._dirty.add(term)
+        db.set_key(self._PAGE_PREFIX + normname, terms, False)
+
+    def _remove_page(self, db, normname):
+        if not self._is_ready(db):
+            return
+        key = self._PAGE_PREFIX + normname
+        for term in db.get_key(key, set()):
+            self._get_postings(db, term).discard(normname)
+            self._dirty.add(term)
+        db.del_key(key)
+
+    def _flush(self, db, sync):
+        vocabulary = self._get_vocabulary(db)
+        for term in self._dirty:
+            key = self._term_key(term)
+            names = self._postings[term]
+            if len(names) > 0:
+                db.set_key(key, names, False)
+                vocabulary.add(term)
+            else:
+                db.del_key(key)
+                vocabulary.discard(term)
+        self._dirty = set()
+        self._postings = { }
+        if sync:
+            db.sync()
+
+    def _candidates(self, db, token):
+        terms = [ t for t in self._get_vocabulary(db) if token in t ]
+        if len(terms) > self.MAX_EXPANSION:
+            return None
+        names = set()
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings == None:
+                postings = db.get_key(self._term_key(term), ())
+            names.update(postings)
+        return names
+
+    def _get_postings(self, db, term):
+        names = self._postings.get(term)
+        if names == None:
+            names = db.get_key(self._term_key(term), set())
+            self._postings[term] = names
+        return names
+
+    def _get_vocabulary(self, db):
+        if self._vocabulary == None:
+            plen = len(self._TERM_PREFIX)
+            self._vocabulary = set([ key[plen:].decode("utf-8")
+                for key in db.keys(self._TERM_PREFIX) ])
+        return self._vocabulary
+
+    def _term_key(self, term):
+        return self._TERM_PREFIX + term.encode("utf-8")
+
+
+def trigrams(text):
+    """ Returns the set of trigrams (three character substrings) of the
+    given text. """
+    return set([ text[i:i+3] for i in range(len(text) - 2) ])
+
+
+class TrigramIndex(object):
+    """ Index of the trigrams found in the page names, used to answer
+    substring queries over names. The index is held in memory and mirrored
+    in the database, one record per trigram (a set of normalized page
+    names) under the prefix 'trigram:'. Names are indexed in lowercase.
+    Changed trigrams are only written to the database by 'flush'.
+
+    As with FullTextIndex, the pages returned by 'candidates' must still
+    be checked by the caller.
+    """
+
+    _PREFIX = "trigram:"
+    _VERSION_KEY = "trigrams"
+    _VERSION = 1
+
+    def __init__(self, db):
+        self._db = db
+        self._postings = None
+        self._page_trigrams = None
+        self._dirty = set()
+
+    @property
+    def is_loaded(self):
+        return self._postings != None
+
+    def reset(self):
+        """ Discards the index held in memory and any change not flushed
+        yet. """
+        self._postings = None
+        self._page_trigrams = None
+        self._dirty = set()
+
+    def load(self):
+        """ Loads the index from the database. Returns False if there is no
+        index for this database. """
+        if self._db.get_key(self._VERSION_KEY) != self._VERSION:
+            return False
+        plen = len(self._PREFIX)
+        self._postings = { }
+        self._page_trigrams = { }
+        for key, names in self._db.pairs(self._PREFIX):
+            tri = key[plen:].decode("utf-8")
+            self._postings[tri] = names
+            for name in names:
+                self._page_trigrams.setdefault(name, set()).add(tri)
+        return True
+
+    def rebuild(self, names):
+        """ Discards the current index and indexes the names given by the
+        iterable 'names', which yields (normalized name, name) pairs. """
+        for key in list(self._db.keys(self._PREFIX)):
+            self._db.del_key(key)
+        self._postings = { }
+        self._page_trigrams = { }
+        self._dirty = set()
+        for normname, name in names:
+            self._add(normname, name)
+        self.flush()
+        self._db.set_key(self._VERSION_KEY, self._VERSION, False)
+
+    def add_page(self, normname, name):
+        """ Indexes the name of the page 'normname'. """
+        self._add(normname, name)
+
+    def remove_page(self, normname):
+        """ Removes the page 'normname' from the index. """
+        self._remove(normname)
+
+    def flush(self):
+        """ Writes the changed trigrams to the database. The database is
+        not synced. """
+        for tri in self._dirty:
+            key = self._PREFIX + tri.encode("utf-8")
+            names = self._postings.get(tri)
+            if names:
+                self._db.set_key(key, names, False)
+            else:
+                self._db.del_key(key)
+                self._postings.pop(tri, None)
+        self._dirty = set()
+
+    def candidates(self, term):
+        """ Returns the set of normalized names of the pages whose names may
+        contain 'term' (a lowercase Unicode string) or None if the term is
+        too short to use the index. """
+        tris = trigrams(term)
+        if len(tris) == 0:
+            return None
+        # Intersects the smallest postings first.
+        tris = sorted(tris, key=lambda tri: len(self._postings.get(tri, ())))
+        names = None
+        for tri in tris:
+            postings = self._postings.get(tri)
+            if not postings:
+                return set()
+            if names == None:
+                names = set(postings)
+            else:
+                names &= postings
+            if len(names) == 0:
+                break
+        return names
+
+    def _add(self, normname, name):
+        tris = trigrams(name.strip().lower())
+        old_tris = self._page_trigrams.get(normname, set())
+        if tris == old_tris:
+            return
+        for tri in old_tris - tris:
+            self._postings[tri].discard(normname)
+        for tri in tris - old_tris:
+            self._postings.setdefault(tri, set()).add(normname)
+        self._page_trigrams[normname] = tris
+        self._dirty.update(tris ^ old_tris)
+
+    def _remove(self, normname):
+        tris = self._page_trigrams.pop(normname, set())
+        for tri in tris:
+            self._postings[tri].discard(normname)
+        self._dirty.update(tris)
+
+
+class BKTree(object):
+    """ Burkhard-Keller tree over a set of strings, used to find the words
+    nearest to a given one under a metric 'distance' (eg. the Levenshtein
+    distance) without comparing it against every word. Removed words are
+    only marked and dropped when enough of them accumulate to justify
+    rebuilding the tree.
+    """
+
+    def __init__(self, distance, words = ()):
+        self._distance = distance
+        self._root = None
+        self._words = set()
+        self._removed = set()
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self._words) - len(self._removed)
+
+    def __contains__(self, word):
+        return word in self._words and word not in self._removed
+
+    def add(self, word):
+        if word in self._words:
+            self._removed.discard(word)
+            return
+        self._words.add(word)
+        if self._root == None:
+            self._root = (word, { })
+            return
+        node = self._root
+        while True:
+            dist = self._distance(word, node[0])
+            child = node[1].get(dist)
+            if child == None:
+                node[1][dist] = (word, { })
+                return
+            node = child
+
+    def remove(self, word):
+        if word in self._words:
+            self._removed.add(word)
+            if len(self._removed) > len(self._words) / 2:
+                words = self._words - self._removed
+                self._root = None
+                self._words = set()
+                self._removed = set()
+                for word in words:
+                    self.add(word)
+
+    def nearest(self, word, count):
+        """ Returns a list with up to 'count' (distance, word) pairs for the
+        words nearest to 'word', sorted by distance. """
+        if self._root == None or count < 1:
+            return [ ]
+        results = [ ]
+        limit = None
+        # Best first traversal: subtrees are visited in the order of the
+        # lower bound of the distances of their words to 'word'.
+        queue = [ (0, 0, self._root) ]
+        serial = 0
+        while len(queue) > 0:
+            bound, n, node = heapq.heappop(queue)
+            if limit != None and bound > limit:
+                break
+            dist = self._distance(word, node[0])
+            if node[0] not in self._removed \
+            and (limit == None or dist <= limit):
+                results.append((dist, node[0]))
+                if len(results) >= count:
+                    results.sort()
+                    del results[count:]
+                    limit = results[-1][0]
+            for edge, child in node[1].iteritems():
+                child_bound = abs(edge - dist)
+                if limit == None or child_bound <= limit:
+                    serial += 1
+                    heapq.heappush(queue, (child_bound, serial, child))
+        results.sort()
+        return results
@@ -23,100 +23,222 @@ Page management module.
 """
 
 import re
+import sys
+import time
+import hashlib
 
-# Uses the module python-levenshtein for similarity searches, if available.
-HAVE_LEVENSHTEIN=False
-try:
-    import Levenshtein
-    HAVE_LEVENSHTEIN=True
-except: pass
+import editdistance
+from pageindex import FullTextIndex, TrigramIndex, BKTree, tokenize
+from records import PageRecord
+from revisions import RevisionLog
+from utils import LRUCache
 
 
 class PageManager(object):
     _ENCODING = "utf-8"
     _PREFIX = "page:"
+    _META_PREFIX = "pagemeta:"
+    _META_VERSION_KEY = "pagemeta"
+    _META_VERSION = 3
+    _POS_PREFIX = "pagepos:"
+    _DATE_NAME_RE = re.compile(r"^([0-9]+)-([0-9]+)-([0-9]+)$")
     SEARCH_ALL = 1
     SEARCH_ANY = 2
     SEARCH_EXACT = 3
     SEARCH_LEVENSHTEIN = 4
 
+    # Memory used by the cache of recently loaded pages, in bytes.
+    CACHE_SIZE = 4 * 1024 * 1024
+
     def __init__(self, db):
         """ Creates a new page manager using the given database. """
         self.db = db
+        self.cache = PageCache(PageManager.CACHE_SIZE)
+        self._fts = FullTextIndex(db)
+        self._trigrams = TrigramIndex(db)
+        self._names = None      # Normalized names -> page names.
+        self._meta = None       # Normalized names -> page metadata.
+        self._positions = { }   # Normalized names -> saved positions.
+        self._similar = None    # Name matcher for similarity searches.
+        self._dates = None      # (year, month) -> days having pages.
+        self.revisions = RevisionLog(db)
+        self.keep_revisions = False     # Add a revision on every save
+        # Incremented whenever a page is created or deleted.
+        self.names_generation = 0
 
     def exists(self, pagename):
-        """ Returns True if the database have a page with the given name. """
-        return self.db.has_key(self._db_key(pagename))
+        """ Returns True if the database have a page with the given name.
+        Answered from the page names kept in memory, loaded on the first
+        call and updated as pages are saved or deleted. """
+        return Page.normalize_name(pagename) in self._display_names()
 
     def load(self, pagename):
         """ Loads the given page from the database. Returns the page object
         or None if the page do not exists. """
-        rec = self.db.get_key(self._db_key(pagename), None)
-        if not rec:
+        normname = Page.normalize_name(pagename)
+        if normname not in self._display_names():
             return None
-        return self._decode_page(rec)
+        rec = pos = None
+        if normname not in self.cache:
+            rec = self.db.get_key(PageManager._PREFIX + normname, None)
+        if normname not in self._positions:
+            pos = self.db.get_key(PageManager._POS_PREFIX + normname)
+        return self._loaded(normname, rec, pos)
+
+    def load_async(self, pagename, callback, call_soon):
+        """ Loads the given page as 'load', but without waiting for the
+        database: 'callback' is called with the page (or None) once its
+        records are read. The database worker hands them over by calling
+        'call_soon(func, *args)', which must call 'func(*args)' in the
+        thread using this object (eg. 'gobject.idle_add' for the GUI).
+        Pages kept in memory are given to 'callback' at once. """
+        normname = Page.normalize_name(pagename)
+        if normname not in self._display_names():
+            callback(None)
+            return
+        futures = [ None, None ]
+        if normname not in self.cache:
+            futures[0] = self.db.get_key_async(PageManager._PREFIX + normname)
+        if normname not in self._positions:
+            futures[1] = self.db.get_key_async(
+                PageManager._POS_PREFIX + normname)
+        pending = [ future for future in futures if future != None ]
+        if len(pending) == 0:
+            callback(self._loaded(normname, None, None))
+            return
+        _when_done(pending, lambda: call_soon(self._deliver_page, normname,
+            futures, callback))
 
     def save(self, page, sync = True):
         """ Saves the page to the database. Name is always taken from
         the 'name' property. If 'sync' is False, the database will not
-        be flushed/sinc()ed. """
-        if page.text == None or page.text == u"":
-            self.delete(page.name)
-        else:
-            self.db.set_key(PageManager._PREFIX + page.normalized_name,
-                ( page.name, page.text, page.cursor_pos ), sync)
+        be flushed/sinc()ed. Nothing is written if the page is unchanged;
+        returns False in this case. """
+        if not self._save(page):
+            return False
+        self._flush_indexes(sync)
+        return True
 
     def delete(self, pagename):
         """ Deletes the given page from the database. """
-        self.db.del_key(self._db_key(pagename))
+        self._delete(Page.normalize_name(pagename))
+        self._flush_indexes(False)
+
+    def list_revisions(self, pagename):
+        """ Returns the (number, time saved) of the revisions kept for the
+        given page, the oldest first. Revisions are added on every save if
+        'keep_revisions' is True and removed when the page is deleted. """
+        return self.revisions.list(Page.normalize_name(pagename))
+
+    def load_revision(self, pagename, number):
+        """ Returns the given page with the text of one of its revisions, or
+        None if there is no such revision. """
+        normname = Page.normalize_name(pagename)
+        text = self.revisions.get(normname, number)
+        if text == None:
+            return None
+        return Page(self._display_names().get(normname, pagename), text)
+
+    def restore_revision(self, pagename, number):
+        """ Saves the text of the given revision as the text of the page.
+        Returns the page saved or None if there is no such revision. """
+        page = self.load_revision(pagename, number)
+        if page != None:
+            self.save(page)
+        return page
+
+    def save_many(self, pages):
+        """ Saves all pages given by the iterable 'pages' in a single
+        database batch, so they are written atomically and flushed once.
+        The search index is also updated only once for every group of
+        pages. """
+        self._run_batch(self._save, pages)
+
+    def delete_many(self, pagenames):
+        """ Deletes all pages named in the iterable 'pagenames' in a single
+        database batch. """
+        self._run_batch(lambda name: self._delete(Page.normalize_name(name)),
+            pagenames)
+
+    def reset(self):
+        """ Discards the pages and indexes held in memory, so they are read
+        again from the database. Must be called after aborting a database
+        batch which changed pages. """
+        self.cache.clear()
+        self._names = None
+        self._meta = None
+        self._positions = { }
+        self._similar = None
+        self._dates = None
+        self.names_generation += 1
+        self._trigrams.reset()
+        self._fts.reset()
 
     def iterate(self):
         """ Iterates through the pages in the DB """
-        for rec in self.db.pairs():
-            if rec[0].startswith(PageManager._PREFIX):
-                yield self._decode_page(rec[1])
+        for rec in self.db.pairs(PageManager._PREFIX):
+            yield self._decode_page(rec[1])
 
     def iterate_names(self):
         """ Iterate through normalized page names of a database. Returns the
         names as Unicode strings (not as byte arrays).
         """
         prefixlen = len(PageManager._PREFIX)
-        for key in self.db.keys():
-            if key.startswith(PageManager._PREFIX):
-                yield key[prefixlen:].decode(PageManager._ENCODING)
+        for key in self.db.keys(PageManager._PREFIX):
+            yield key[prefixlen:].decode(PageManager._ENCODING)
+
+    def get_meta(self, pagename):
+        """ Returns the metadata of the given page, without loading it, or
+        None if the page does not exist. The metadata is a dictionary with
+        the keys 'name' (the page name), 'size' (text length in bytes, as
+        UTF-8), 'created' and 'modified' (as seconds since the epoch or None,
+        if unknown) and 'hash' (SHA-1 digest of the text). """
+        self._display_names()
+        meta = self._meta.get(Page.normalize_name(pagename))
+        if meta == None:
+            return None
+        return dict(meta)
+
+    def iterate_meta(self):
+        """ Iterates through the (normalized name, metadata) pairs of all
+        pages, with metadata as returned by 'get_meta'. """
+        self._display_names()
+        for normname in sorted(self._meta):
+            yield normname.decode(PageManager._ENCODING), \
+                dict(self._meta[normname])
+
+    def month_days(self, year, month):
+        """ Returns the set of days of the given month having pages. """
+        return set(self._date_index().get((year, month), ()))
+
+    def year_days(self, year):
+        """ Returns a dictionary mapping the months (1 to 12) of the given
+        year having pages to the sets of their days having pages. """
+        index = self._date_index()
+        return dict([ (month, set(index[(year, month)]))
+            for month in range(1, 13) if (year, month) in index ])
 
     def levenshtein_search(self, term, max_results=30):
         """ Searches for pages for names near to the given term according
         to the Levenshtein distance. This method returns a list with up to
         'max_results' page names sorted according to its similarity to the
-        search term.
+        search term. Names are searched in a BK-tree built on the first
+        call, so no page is loaded; without the python-levenshtein module,
+        every name is scored with the (batched) bit-parallel algorithm,
+        which is faster in Python than walking the tree.
         """
         
-        if not HAVE_LEVENSHTEIN: raise Exception("Module not available")
         term = Page.normalize_name(term).decode("utf-8")
-        
-        # To avoid either giant result queues and too many small list sorting
-        # operations. The best value for this parameter is a bit heuristic.
-        optimal_queue_len = max(100, 3*max_results)
-        worst_result = 2**31    # Interval reasoning to discard bad results.
-
-        results = [ ]
-        for curname in self.iterate_names():
-            ldist = Levenshtein.distance(term, curname)
-            if ldist < worst_result:
-                results.append((curname, ldist))
-                if len(results) > optimal_queue_len:
-                    results = sorted(results, key=lambda result: result[1])
-                    results = results[0:max_results]
-                    worst_result = results[-1][1]
-        results = sorted(results, key=lambda result: result[1])
-        results = results[0:max_results]
-
-        # Get the real (non-normalized) names for the pages found.
-        retvals = [ ]
-        for temp in results:
-            retvals.append(self.load(temp[0]).name)
-        return retvals
+        names = self._display_names()
+        if self._similar == None:
+            words = [ name.decode(PageManager._ENCODING) for name in names ]
+            if editdistance.HAVE_LEVENSHTEIN:
+                self._similar = BKTree(editdistance.distance, words)
+            else:
+                self._similar = editdistance.BatchMatcher(words)
+        results = self._similar.nearest(term, max_results)
+        return [ names[name.encode(PageManager._ENCODING)]
+            for dist, name in results ]
         
     def search(self, terms, mode = SEARCH_ALL, case_sensitive = False,
         full_text = False, return_set = True, callback = None):
@@ -133,67 +255,414 @@ class PageManager(object):
         method to return a set with the page-objects found. Unless is None,
         'callback' will be called for each page found, giving it as the only
         argument.
-        
-        BUGS: Very, very slow.
+
+        Candidate pages are taken from the index of the page names or, for
+        full text searches and name terms too short for it, from the full
+        text index, which is built on the first such search; only these
+        pages are loaded. Names are matched against the page metadata, so
+        searches by name only load the pages found; 'search_names' does not
+        load them at all.
         """
         
-        # Prepare search terms
-        terms = terms.strip()
-        if len(terms) < 1:
-            raise ValueError("No search terms were given")
-        if not case_sensitive:
-            terms = terms.lower()
-        if mode == PageManager.SEARCH_ALL or mode == PageManager.SEARCH_ANY:
-            term_list = re.split('\s+', terms)
-        elif mode == PageManager.SEARCH_EXACT:
-            term_list = [ terms ]
+        term_list = _split_terms(terms, mode, case_sensitive)
+        if full_text:
+            candidates = self._search_candidates(term_list, mode, True)
+            if candidates == None:
+                pages = self.iterate()
+            else:
+                pages = self._iterate_normalized(sorted(candidates))
         else:
-            raise ValueError("Bad search mode", mode)
-            
+            pages = self._iterate_normalized(
+                self._match_names(term_list, mode, case_sensitive))
+
         retset = set()
-        for page in self.iterate():
-            # Prepare current page terms
-            if case_sensitive:
-                name = page.name
-                if full_text: text = page.text
-            else:
-                name = page.name.lower()
-                if full_text: text = page.text.lower()
-
-            # Search
-            match = False
-            if mode == self.SEARCH_ALL:
-                match = True
-                for word in term_list:
-                    if name.find(word) < 0 and (full_text == False or text.find(word) < 0):
-                        match = False
-                        break
-            elif mode == self.SEARCH_ANY:
-                for word in term_list:
-                    if name.find(word) > -1 or (full_text and text.find(word) > -1):
-                        match = True
-                        break
-            elif mode == self.SEARCH_EXACT:
-                word = term_list[0]
-                if name.find(word) > -1 or (full_text and text.find(word) > -1):
-                    match = True
-
-            if match:
+        for page in pages:
+            if _match_terms(page.name, page.text if full_text else None,
+            term_list, mode, case_sensitive):
                 if callback != None: callback(page)
                 if return_set: retset.add(page) 
 
         if return_set:
             return retset
 
+    def search_names(self, terms, mode = SEARCH_ALL, case_sensitive = False):
+        """ Searches the page names as 'search', without loading the pages.
+        Returns the list of the names found, sorted by their normalized
+        names. """
+        term_list = _split_terms(terms, mode, case_sensitive)
+        names = self._display_names()
+        return [ names[normname] for normname in
+            self._match_names(term_list, mode, case_sensitive) ]
+
+    def rebuild_index(self):
+        """ Rebuilds the page metadata and the search indexes from the pages
+        in the database. """
+        self._rebuild_meta()
+        self._trigrams.rebuild(self._display_names().iteritems())
+        self._fts.rebuild(self._iterate_normalized(list(self.iterate_names())))
+        self.db.sync()
+
+    def _save(self, page):
+        # Saves a page, leaving the index changes in their caches. The
+        # metadata must be loaded (or built) before the page is changed.
+        # Returns False if nothing was written.
+        names = self._display_names()
+        normname = page.normalized_name
+        if page.text == None or page.text == u"":
+            if normname not in names:
+                return False
+            self._delete(normname)
+            return True
+        old = self._meta.get(normname)
+        if old != None and old["hash"] == page.text_hash() \
+        and old["name"] == page.name:
+            return self._save_position(page)
+        self._write_page(page)
+        if page.scroll_pos == None:
+            # The position in the page record is enough.
+            self.db.del_key(PageManager._POS_PREFIX + normname)
+            self._positions[normname] = (page.cursor_pos, None)
+        else:
+            self._save_position(page)
+        self._update_meta(normname, page)
+        if self.keep_revisions:
+            self.revisions.add(normname, page.text)
+        self._name_index().add_page(normname, page.name)
+        self._fts.add_page(normname, page.name, page.text)
+        return True
+
+    def _write_page(self, page):
+        rec = PageRecord(page.name, page.text, page.cursor_pos)
+        self.db.set_key(PageManager._PREFIX + page.normalized_name, rec, False)
+        self.cache.put(page.normalized_name, self._decode_page(rec))
+
+    def _save_position(self, page):
+        # The cursor and scroll positions are kept in their own record, so
+        # moving around a page does not rewrite it. Positions are compared
+        # with the ones loaded or saved, if known. Returns False if they did
+        # not change.
+        normname = page.normalized_name
+        pos = (page.cursor_pos, page.scroll_pos)
+        if self._positions.get(normname) == pos:
+            return False
+        self.db.set_key(PageManager._POS_PREFIX + normname, pos, False)
+        self._positions[normname] = pos
+        return True
+
+    def _delete(self, normname):
+        self.db.del_key(PageManager._PREFIX + normname)
+        self.db.del_key(PageManager._POS_PREFIX + normname)
+        self.cache.remove(normname)
+        self._positions.pop(normname, None)
+        self._update_meta(normname, None)
+        self.revisions.remove(normname)
+        self._name_index().remove_page(normname)
+        self._fts.remove_page(normname)
+
+    def _run_batch(self, func, items):
+        # Calls 'func' for every item in a database batch, flushing the
+        # indexes periodically. If the batch fails, the pages and indexes
+        # held in memory no longer match the database and are discarded.
+        try:
+            with self.db.batch():
+                for count, item in enumerate(items):
+                    func(item)
+                    if (count + 1) % FullTextIndex.FLUSH_INTERVAL == 0:
+                        self._flush_indexes(False)
+                self._flush_indexes(False)
+        except:
+            self.reset()
+            raise
+
+    def _flush_indexes(self, sync):
+        if self._trigrams.is_loaded:
+            self._trigrams.flush()
+        self._fts.flush(sync)
+
+    def _name_index(self):
+        # Returns the trigram index, loading or building it if needed.
+        if not self._trigrams.is_loaded and not self._trigrams.load():
+            self._trigrams.rebuild(self._display_names().iteritems())
+        return self._trigrams
+
+    def _full_text_index(self):
+        # Returns the full-text index, building it if needed.
+        if not self._fts.is_ready:
+            self._fts.rebuild(self._iterate_normalized(
+                list(self.iterate_names())))
+        return self._fts
+
+    def _display_names(self):
+        # Returns the dictionary mapping the normalized page names to the
+        # page names, loaded with the page metadata from their records or
+        # built from the pages if there are no such records.
+        if self._names == None:
+            if self.db.get_key(PageManager._META_VERSION_KEY) == \
+            PageManager._META_VERSION:
+                self._names = { }
+                self._meta = { }
+                plen = len(PageManager._META_PREFIX)
+                for key, meta in self.db.pairs(PageManager._META_PREFIX):
+                    self._names[key[plen:]] = meta["name"]
+                    self._meta[key[plen:]] = meta
+            else:
+                self._rebuild_meta()
+        return self._names
+
+    def _date_index(self):
+        # Returns the dictionary mapping (year, month) to the set of days
+        # having pages, built from the page names.
+        names = self._display_names()
+        if self._dates == None:
+            self._dates = { }
+            for normname in names:
+                self._index_date(normname, True)
+        return self._dates
+
+    def _index_date(self, normname, add):
+        # Adds or removes a page from the date index, if its name is a date.
+        match = PageManager._DATE_NAME_RE.match(normname)
+        if match == None:
+            return
+        year, month, day = [ int(n) for n in match.groups() ]
+        days = self._dates.setdefault((year, month), set())
+        if add:
+            days.add(day)
+        else:
+            days.discard(day)
+            if len(days) == 0:
+                del self._dates[(year, month)]
+
+    def _rebuild_meta(self):
+        # Rebuilds the metadata records from the pages, keeping the known
+        # creation and modification times.
+        self._names = { }
+        self._meta = { }
+        self._similar = None
+        self._dates = None
+        self.names_generation += 1
+        times = { }
+        for key, meta in list(self.db.pairs(PageManager._META_PREFIX)):
+            if isinstance(meta, dict):
+                times[key] = (meta.get("created"), meta.get("modified"))
+            self.db.del_key(key)
+        for page in self.iterate():
+            key = PageManager._META_PREFIX + page.normalized_name
+            created, modified = times.get(key, (None, None))
+            meta = _make_meta(page, created, modified)
+            self._names[page.normalized_name] = page.name
+            self._meta[page.normalized_name] = meta
+            self.db.set_key(key, meta, False)
+        self.db.set_key(PageManager._META_VERSION_KEY,
+            PageManager._META_VERSION)
+
+    def _update_meta(self, normname, page):
+        # Updates the page metadata after a page is saved or deleted (if
+        # 'page' is None).
+        names = self._display_names()
+        key = PageManager._META_PREFIX + normname
+        if page == None:
+            if normname in names:
+                del names[normname]
+                del self._meta[normname]
+                self.names_generation += 1
+                self.db.del_key(key)
+                if self._similar != None:
+                    self._similar.remove(normname.decode(PageManager._ENCODING))
+                if self._dates != None:
+                    self._index_date(normname, False)
+            return
+        now = int(time.time())
+        old = self._meta.get(normname)
+        meta = _make_meta(page, now, now)
+        if old != None:
+            meta["created"] = old["created"]
+            if old["hash"] == meta["hash"] and old["name"] == meta["name"]:
+                meta["modified"] = old["modified"]
+        if meta != old:
+            self.db.set_key(key, meta, False)
+            self._meta[normname] = meta
+        if normname not in names:
+            self.names_generation += 1
+            if self._similar != None:
+                self._similar.add(normname.decode(PageManager._ENCODING))
+            if self._dates != None:
+                self._index_date(normname, True)
+        names[normname] = page.name
+
+    def _search_candidates(self, term_list, mode, full_text):
+        # Returns the set of normalized names of the pages that may match
+        # the search or None if all pages must be checked. Name searches
+        # use the trigram index only, as the names are in memory anyway;
+        # otherwise, every word of a search term must be part of some word
+        # of the page name or text.
+        candidates = None
+        for term in term_list:
+            if full_text:
+                term_candidates = self._token_candidates(term)
+            else:
+                term_candidates = self._name_index().candidates(term.lower())
+            if term_candidates == None:
+                if mode == PageManager.SEARCH_ANY:
+                    return None
+                continue
+            if candidates == None:
+                candidates = term_candidates
+            elif mode == PageManager.SEARCH_ANY:
+                candidates |= term_candidates
+            else:
+                candidates &= term_candidates
+        return candidates
+
+    def _match_names(self, term_list, mode, case_sensitive):
+        # Returns the sorted normalized names of the pages whose names match
+        # the search terms, matched from the names held in memory.
+        names = self._display_names()
+        candidates = self._search_candidates(term_list, mode, False)
+        if candidates == None:
+            candidates = names.keys()
+        return sorted([ normname for normname in candidates
+            if normname in names and _match_terms(names[normname], None,
+                term_list, mode, case_sensitive) ])
+
+    def _token_candidates(self, term):
+        candidates = None
+        fts = self._full_text_index()
+        for token in tokenize(term):
+            names = fts.candidates(token)
+            if names == None:
+                continue
+            if candidates == None:
+                candidates = names
+            else:
+                candidates &= names
+        return candidates
+
+    def _iterate_normalized(self, names):
+        # Loads the pages given by their normalized names.
+        for name in names:
+            if isinstance(name, unicode):
+                name = name.encode(PageManager._ENCODING)
+            rec = self.db.get_key(PageManager._PREFIX + name, None)
+            if rec:
+                yield self._decode_page(rec)
+
+    def _loaded(self, normname, rec, pos):
+        # Returns the page loaded, given its record and the record of its
+        # position, when they are not kept in memory (or None).
+        page = self.cache.get(normname)
+        if page == None:
+            if not rec:
+                # Dropped from the cache while it was being loaded.
+                rec = self.db.get_key(PageManager._PREFIX + normname, None)
+                if not rec:
+                    return None
+            page = self._decode_page(rec)
+            self.cache.put(normname, page)
+        if normname not in self._positions:
+            if pos == None:
+                # Only the cursor position in the page record is known.
+                pos = (page.cursor_pos, None)
+            self._positions[normname] = pos
+        page.cursor_pos, page.scroll_pos = self._positions[normname]
+        return page
+
+    def _deliver_page(self, normname, futures, callback):
+        # Gives the page read by 'load_async' to its callback.
+        rec = pos = None
+        if futures[0] != None:
+            rec = futures[0].result()
+        if futures[1] != None:
+            pos = futures[1].result()
+        callback(self._loaded(normname, rec, pos))
+
     def _decode_page(self, dbrecord):
+        # Records written by older versions hold Unicode strings.
         p = Page()
-        p.name = dbrecord[0].decode(PageManager._ENCODING)
-        p.text = dbrecord[1].decode(PageManager._ENCODING)
+        p.name = _decode_str(dbrecord[0])
+        p.text = _decode_str(dbrecord[1])
         p.cursor_pos = dbrecord[2]
         return p
 
-    def _db_key(self, pagename):
-        return PageManager._PREFIX + Page.normalize_name(pagename)
+
+
+def _when_done(futures, func):
+    # Calls 'func' when all futures are done.
+    if len(futures) == 0:
+        func()
+    else:
+        futures[0].add_done_callback(lambda future:
+            _when_done(futures[1:], func))
+
+def _decode_str(s):
+    if isinstance(s, unicode):
+        return s
+    return s.decode(PageManager._ENCODING)
+
+def _make_meta(page, created, modified):
+    # Returns the metadata record of a page.
+    return { "name": page.name, "size": len(page.text.encode("utf-8")),
+        "created": created, "modified": modified, "hash": page.text_hash() }
+
+def _split_terms(terms, mode, case_sensitive):
+    # Returns the list of search terms for the search mode.
+    terms = terms.strip()
+    if len(terms) < 1:
+        raise ValueError("No search terms were given")
+    if not case_sensitive:
+        terms = terms.lower()
+    if mode == PageManager.SEARCH_ALL or mode == PageManager.SEARCH_ANY:
+        return re.split('\s+', terms)
+    elif mode == PageManager.SEARCH_EXACT:
+        return [ terms ]
+    raise ValueError("Bad search mode", mode)
+
+def _match_terms(name, text, term_list, mode, case_sensitive):
+    # Checks a page name (and text, unless None) against the search terms.
+    if not case_sensitive:
+        name = name.lower()
+        if text != None: text = text.lower()
+    if mode == PageManager.SEARCH_ALL:
+        for word in term_list:
+            if name.find(word) < 0 and (text == None or text.find(word) < 0):
+                return False
+        return True
+    elif mode == PageManager.SEARCH_ANY:
+        for word in term_list:
+            if name.find(word) > -1 or (text != None and text.find(word) > -1):
+                return True
+        return False
+    elif mode == PageManager.SEARCH_EXACT:
+        word = term_list[0]
+        return name.find(word) > -1 or (text != None and text.find(word) > -1)
+    return False
+
+
+
+class PageCache(LRUCache):
+    """ LRU cache of decoded pages, indexed by their normalized names and
+    bounded by the memory used by their names and texts. Pages are copied
+    when stored and returned, so the callers can not change the cached
+    ones.
+    """
+
+    def __init__(self, max_size):
+        LRUCache.__init__(self, max_size, _page_size)
+
+    def get(self, key):
+        """ Returns a copy of the page cached for 'key' or None. """
+        page = LRUCache.get(self, key)
+        if page == None:
+            return None
+        return page.clone()
+
+    def put(self, key, page):
+        """ Caches a copy of 'page' as 'key', dropping the least recently
+        used pages if needed. """
+        LRUCache.put(self, key, page.clone())
+
+def _page_size(page):
+    return sys.getsizeof(page.name) + sys.getsizeof(page.text)
 
 
 
@@ -202,6 +671,10 @@ class Page(object):
     def __init__(self, name = None, text = None):
         """ Creates a new page entry with default values. """
         self._cursor_pos = 0
+        self.scroll_pos = None  # Offset of the first visible character.
+        self._name = None
+        self._text = None
+        self._hash = None
         self.name = name or u""
         self.text = text or u""
 
@@ -266,6 +739,8 @@ class Page(object):
     cursor_pos = property(_get_cursor_pos, _set_cursor_pos)
 
     def _set_text(self, text):
+        if text != self._text:
+            self._hash = None
         self._text = text
         self._revalidate_cursor_pos()
 
@@ -274,10 +749,19 @@ class Page(object):
 
     text = property(_get_text, _set_text)
 
+    def text_hash(self):
+        """ Returns the SHA-1 digest of the text (encoded as UTF-8), kept
+        until the text is changed. """
+        if self._hash == None:
+            self._hash = hashlib.sha1(self._text.encode("utf-8")).digest()
+        return self._hash
+
     def __repr__(self):
         return "Page:'" + self.normalized_name + "'"
 
     def clone(self):
         p = Page(self.name, self.text)
         p.cursor_pos = self.cursor_pos
+        p.scroll_pos = self.scroll_pos
+        p._hash = self._hash
         return p
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# Sked - a wikish scheduler with Python and PyGTK
+# (c) 2006-10 Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA.
+
+"""
+Format of the records stored in the database.
+
+Every record starts with a header byte: the high nibble selects how the
+value was serialized (pickled or, for pages, packed as UTF-8 strings) and
+the low nibble how the payload was compressed (stored as is, zlib or zlib
+with a preset dictionary). Records written by older versions are zlib
+streams of pickles, whose first byte is always 0x78; no header uses this
+value, so they are still read.
+"""
+
+import re
+import struct
+import zlib
+import cPickle as pickle
+
+# Serializers (high nibble).
+PICKLE = 0x00
+PAGE = 0x10
+
+# Codecs (low nibble).
+RAW = 0x01
+ZLIB = 0x02
+ZDICT = 0x03
+
+_LEGACY = 0x78
+
+# Zlib compression level used by default.
+DEFAULT_LEVEL = 6
+
+# Payloads smaller than this are not worth compressing.
+MIN_COMPRESS = 64
+
+# Preset dictionary for page records: strings expected to be common in the
+# pages, the most common ones at the end (zlib encodes nearer matches with
+# fewer bits). Records compressed with it can only be read back with the
+# very same dictionary, so it must NEVER be changed; a new dictionary needs
+# a new codec.
+PAGE_DICTIONARY = "".join([
+    "http://www.https://.com.org.net.br/index.html ",
+    "January February March April May June July August September ",
+    "October November December Monday Tuesday Wednesday Thursday Friday ",
+    "Saturday Sunday janeiro fevereiro abril maio junho julho agosto ",
+    "setembro outubro novembro dezembro segunda terça quarta quinta sexta ",
+    "sábado domingo não para com uma por mais como dos das que ",
+    "about after again also because before being could would should ",
+    "there their these those which while where when what with from ",
+    "have this that will your into them then than only just some ",
+    "meeting call email phone project report review today tomorrow ",
+    "TODO: DONE: Note: Back to [[Index]]\n",
+    "\n  o--------------------------------o\n|||\n",
+    "\n= \n== \n=== ===\n== =\n",
+    " *bold* //italic// _underline_ ",
+    "\n\n * \n - \n - [[ ]] ",
+    " the of and to in is for on at it a ",
+])
+
+# Packed page header: cursor position and length of the name.
+_PAGE_HEADER = struct.Struct("<II")
+
+
+class PageRecord(tuple):
+    """ Page stored as a (name, text, cursor position) tuple. Names and texts
+    are given as Unicode strings (or UTF-8 encoded ones) and are always read
+    back as UTF-8 encoded strings. """
+
+    def __new__(cls, name, text, cursor_pos):
+        return tuple.__new__(cls, (name, text, cursor_pos))
+
+
+def encode(value, level = DEFAULT_LEVEL):
+    """ Returns the record for 'value', compressed with the given zlib level
+    (0 disables compression). """
+    if isinstance(value, PageRecord):
+        fmt = PAGE
+        payload = _pack_page(value)
+    else:
+        fmt = PICKLE
+        payload = pickle.dumps(value, 2)
+    if level > 0 and len(payload) >= MIN_COMPRESS:
+        if fmt == PAGE:
+            codec = ZDICT
+            data = _page_dictionary.compress(payload, level)
+        else:
+            codec = ZLIB
+            data = zlib.compress(payload, level)
+        if len(data) < len(payload):
+            return chr(fmt | codec) + data
+    return chr(fmt | RAW) + payload
+
+
+def decode(record):
+    """ Returns the value stored in 'record'. """
+    header = ord(record[0])
+    if header == _LEGACY:
+        return pickle.loads(zlib.decompress(record))
+    fmt = header & 0xF0
+    codec = header & 0x0F
+    if codec == RAW:
+        payload = record[1:]
+    elif codec == ZLIB:
+        payload = zlib.decompress(record[1:])
+    elif codec == ZDICT:
+        payload = _page_dictionary.decompress(record[1:])
+    else:
+        raise ValueError("Unknown record codec %d" % codec)
+    if fmt == PICKLE:
+        return pickle.loads(payload)
+    elif fmt == PAGE:
+        return _unpack_page(payload)
+    raise ValueError("Unknown record format %d" % fmt)
+
+
+def _to_utf8(s):
+    if isinstance(s, unicode):
+        return s.encode("utf-8")
+    return s
+
+def _pack_page(rec):
+    name = _to_utf8(rec[0])
+    return _PAGE_HEADER.pack(rec[2], len(name)) + name + _to_utf8(rec[1])
+
+def _unpack_page(payload):
+    cursor_pos, nlen = _PAGE_HEADER.unpack_from(payload)
+    start = _PAGE_HEADER.size
+    return PageRecord(payload[start:start+nlen], payload[start+nlen:],
+        cursor_pos)
+
+
+class PresetDictionary(object):
+    """ Zlib compression with a preset dictionary. Python 2 zlib does not
+    support them, so they are emulated: a stream is primed by compressing
+    the dictionary and flushing it to a byte boundary. Compressed data holds
+    only what is written after the priming, which refers back to the
+    dictionary as if it were previous data, and is decompressed by a copy
+    of a decompressor fed with the same priming. """
+
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+        self._compressors = { }
+        self._decompressor = None
+
+    def compress(self, data, level = DEFAULT_LEVEL):
+        comp = self._compressors.get(level)
+        if comp == None:
+            comp = zlib.compressobj(level)
+            comp.compress(self.dictionary)
+            comp.flush(zlib.Z_SYNC_FLUSH)
+            self._compressors[level] = comp
+        comp = comp.copy()
+        return comp.compress(data) + comp.flush()
+
+    def decompress(self, data):
+        if self._decompressor == None:
+            comp = zlib.compressobj()
+            priming = comp.compress(self.dictionary) + \
+                comp.flush(zlib.Z_SYNC_FLUSH)
+            self._decompressor = zlib.decompressobj()
+            self._decompressor.decompress(priming)
+        decomp = self._decompressor.copy()
+        return decomp.decompress(data) + decomp.flush()
+
+_page_dictionary = PresetDictionary(PAGE_DICTIONARY)
+
+
+_WORD_RE = re.compile(r"\S+\s?")
+
+def train_dictionary(texts, size = 4096):
+    """ Builds a preset dictionary of up to 'size' bytes from the words and
+    lines most common in the given sample texts (Unicode strings), weighted
+    by the bytes they would save. """
+    counts = { }
+    for text in texts:
+        text = _to_utf8(text)
+        for line in text.splitlines(True):
+            if len(line) < 80:
+                counts[line] = counts.get(line, 0) + 1
+        for word in _WORD_RE.findall(text):
+            if len(word) > 3:
+                counts[word] = counts.get(word, 0) + 1
+    strings = [ s for s in counts if counts[s] > 1 ]
+    strings.sort(key=lambda s: counts[s] * len(s), reverse=True)
+    chosen = [ ]
+    total = 0
+    for s in strings:
+        if total + len(s) <= size:
+            chosen.append(s)
+            total += len(s)
+    # Most valuable strings go to the end, nearer to the data.
+    chosen.reverse()
+    return "".join(chosen)
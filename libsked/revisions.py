@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Sked - a wikish scheduler with Python and PyGTK
+# (c) 2006-10 Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA.
+
+"""
+Page revisions.
+
+Keeps the texts saved for the pages, so older versions can be restored.
+"""
+
+import time
+import bisect
+
+from undo import diff, patch
+
+
+class RevisionLog(object):
+    """ Log of the texts saved for each page, indexed by the normalized page
+    names. Revisions are numbered from 1 for every page and listed in the
+    record "pagerevs:<name>" as (number, time saved, keyframe) tuples, the
+    oldest first; each revision is kept in the record "pagerev:<number>:
+    <name>". Every KEYFRAME_INTERVAL revisions the full text is kept, with
+    the keyframe flag set, and the other revisions as deltas to the
+    previous one, so any revision is rebuilt from a few records. Only the
+    last 'max_count' revisions, and the ones saved up to 'max_age' seconds
+    ago, are kept; the last revision is always kept. """
+
+    _LIST_PREFIX = "pagerevs:"
+    _PREFIX = "pagerev:"
+    KEYFRAME_INTERVAL = 32
+
+    def __init__(self, db, max_count = 1000, max_age = 365 * 24 * 3600):
+        self._db = db
+        self.max_count = max_count
+        self.max_age = max_age
+
+    def add(self, normname, text, now = None):
+        """ Adds a revision with the given text, unless it is the same text
+        of the last revision, and prunes the older ones. The revision is
+        added through 'run_later' of the database: with an AsyncDatabase,
+        the caller does not wait for the records to be read. """
+        if now == None:
+            now = int(time.time())
+        self._db.run_later(self._add, normname, text, now)
+
+    def list(self, normname):
+        """ Returns the (number, time saved) of the revisions of the page,
+        the oldest first, with the times in seconds since the epoch. """
+        revs = self._db.run(self._get_list, normname)
+        return [ (rev[0], rev[1]) for rev in revs ]
+
+    def get(self, normname, number):
+        """ Returns the text of the given revision or None if there is no
+        such revision. """
+        return self._db.run(self._get, normname, number)
+
+    def remove(self, normname):
+        """ Removes all revisions of the page. """
+        self._db.run_later(self._remove, normname)
+
+    # The methods below are run by the database and use the database
+    # given to them.
+
+    def _get_list(self, db, normname):
+        return db.get_key(RevisionLog._LIST_PREFIX + normname, [ ])
+
+    def _add(self, db, normname, text, now):
+        revs = self._get_list(db, normname)
+        if len(revs) == 0:
+            number = 1
+            full = True
+        else:
+            chain = self._chain(revs, len(revs) - 1)
+            last = self._rebuild(db, normname, chain)
+            if last == text:
+                return
+            number = revs[-1][0] + 1
+            full = len(chain) >= RevisionLog.KEYFRAME_INTERVAL
+        if full:
+            db.set_key(self._key(normname, number), text, False)
+        else:
+            db.set_key(self._key(normname, number), diff(last, text), False)
+        revs.append((number, now, full))
+        revs = self._prune(db, normname, revs, now)
+        db.set_key(RevisionLog._LIST_PREFIX + normname, revs, False)
+
+    def _get(self, db, normname, number):
+        revs = self._get_list(db, normname)
+        i = bisect.bisect_left(revs, (number, ))
+        if i == len(revs) or revs[i][0] != number:
+            return None
+        return self._rebuild(db, normname, self._chain(revs, i))
+
+    def _remove(self, db, normname):
+        revs = db.get_key(RevisionLog._LIST_PREFIX + normname)
+        if revs == None:
+            return
+        for rev in revs:
+            db.del_key(self._key(normname, rev[0]))
+        db.del_key(RevisionLog._LIST_PREFIX + normname)
+
+    def _key(self, normname, number):
+        return "%s%d:%s" % (RevisionLog._PREFIX, number, normname)
+
+    def _chain(self, revs, i):
+        # Returns the revisions needed to rebuild revision 'revs[i]': the
+        # last one with the full text up to it.
+        start = i
+        while not revs[start][2]:
+            start -= 1
+        return revs[start:i + 1]
+
+    def _rebuild(self, db, normname, chain):
+        text = db.get_key(self._key(normname, chain[0][0]))
+        for rev in chain[1:]:
+            text = patch(text, db.get_key(self._key(normname, rev[0])))
+        return text
+
+    def _prune(self, db, normname, revs, now):
+        # Removes the revisions too old or beyond the count limit. Returns
+        # the revisions kept; the first one must have the full text.
+        cutoff = now - self.max_age
+        drop = 0
+        while drop < len(revs) - 1 and (len(revs) - drop > self.max_count
+        or revs[drop][1] < cutoff):
+            drop += 1
+        if drop == 0:
+            return revs
+        number, saved, full = revs[drop]
+        if not full:
+            text = self._rebuild(db, normname, self._chain(revs, drop))
+            db.set_key(self._key(normname, number), text, False)
+            revs[drop] = (number, saved, True)
+        for rev in revs[:drop]:
+            db.del_key(self._key(normname, rev[0]))
+        return revs[drop:]
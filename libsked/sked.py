@@ -36,71 +36,61 @@ import pango
 
 import os               # Operating system stuff
 import re               # Regular expressions
+import time             # Time slices for formatting
+import bisect           # Search in sorted lists
 import webbrowser       # System web browser
 import datetime         # Date validation
 
 import utils
 import database
 import interface
+import markup
 import xmlio
 from pages import *
 from options import *
 from history import *
 from macros import *
+from undo import *
 
 HAVE_DBUS = False
 try:
     import skeddbus
     HAVE_DBUS = True
 except: pass
-    
-
-class UndoRedoManager(object):
 
-    def __init__(self, max_levels = 64):
-        self.max_levels = max_levels
-        self.clear()
 
-    def clear(self):
-        self._undol = [ ]
-        self._redol = [ ]
+def tag_spans(spans, exists):
+    """ Returns the (start, end, tag name) spans for the markup spans given
+    by the markup module. exists(name) tells if a linked page exists. """
+    tags = [ ]
+    for span in spans:
+        tag = span[2]
+        if tag == markup.LINK:
+            if not exists(span[3]):
+                tag = "newlink"
+        elif tag == markup.DATE:
+            if exists(span[3]):
+                tag = "datelink"
+            else:
+                tag = "newdatelink"
+        tags.append((span[0], span[1], tag))
+    return tags
 
-    def clear_redo(self):
-        self._redol = [ ]
 
-    def enqueue(self, page):
-        if len(self._undol) > 0 and self._undol[-1] == page.text:
-            return
-        self.clear_redo()
-        self._undol.append(page.clone())
-        if len(self._undol) > self.max_levels:
-            self._undol = self._undol[-self.max_levels:]
-
-    def undo(self, current = None):
-        if self.can_undo():
-            pg = self._undol.pop()
-            if len(self._redol) == 0 or self._redol[-1].text != pg.text:
-                self._redol.append(pg)
-            if current and self._redol[-1].text != current.text:
-                self._redol.append(current.clone())
-            return pg
-        return None
-
-    def redo(self, current = None):
-        if self.can_redo():
-            pg = self._redol.pop()
-            if len(self._undol) == 0 or self._undol[-1].text != pg.text:
-                self._undol.append(pg)
-            if current and self._undol[-1].text != current.text:
-                self._undol.append(current.clone())
-            return pg
-        return None
-
-    def can_undo(self):
-        return len(self._undol) > 0
-
-    def can_redo(self):
-        return len(self._redol) > 0
+def apply_spans(buf, spans):
+    """ Applies the tags given as (start, end, tag name) spans, sorted by
+    their starting offsets, to the text buffer 'buf', sweeping it forward
+    with a single iterator. """
+    if len(spans) == 0:
+        return
+    pos = spans[0][0]
+    start = buf.get_iter_at_offset(pos)
+    for span in spans:
+        start.forward_chars(span[0] - pos)
+        pos = span[0]
+        end = start.copy()
+        end.forward_chars(span[1] - pos)
+        buf.apply_tag_by_name(span[2], start, end)
 
 
 # Main application class -------------------------------------------------
@@ -116,6 +106,17 @@ class SkedApp(interface.BaseDialog):
     DEFAULT_NEW_PAGE_TEMPLATE = u"\\P\n=== \\a ===\n"
     DEFAULT_REDIRECT_PAGE_TEMPLATE = u"Renamed to \\A\n"
 
+    # Long pages are formatted in parts: about FORMAT_VISIBLE characters
+    # from the first visible one at once, the remaining text in chunks of
+    # FORMAT_CHUNK characters, for up to FORMAT_SLICE seconds each time the
+    # interface becomes idle.
+    FORMAT_VISIBLE = 8192
+    FORMAT_CHUNK = 4096
+    FORMAT_SLICE = 0.02
+
+    # Total number of tag spans kept for the pages visited recently.
+    SPAN_CACHE_SIZE = 200000
+
     DEF_PREFS = {
         "window_x"  : 0,
         "window_y"  : 0,
@@ -124,7 +125,13 @@ class SkedApp(interface.BaseDialog):
         "window_state" : 0, # can be gdk.WINDOW_STATE_MAXIMIZED | ICONIFIED
         "format_time"   : 2,
         "save_time"     : 15,
-        "undo_levels"   : 64,
+        "sync_policy"   : database.EncryptedDatabase.SYNC_ALWAYS,
+        "sync_interval" : 30,
+        "undo_levels"   : 1000,
+        "undo_memory"   : 4 * 1024 * 1024,
+        "keep_revisions": False,
+        "max_revisions" : 1000,
+        "revision_days" : 365,
         "show_edit_buttons" : True,
         "std_color"     : "#000000",
         "header1_color" : "#000000",
@@ -166,11 +173,21 @@ class SkedApp(interface.BaseDialog):
         self.opt = OptionManager(self.db, SkedApp.DEF_PREFS)
         self.bfm = BackForwardManager(self.opt.get_int("max_history"),
             self.db, "back_fwd_state")
-        self.urm = UndoRedoManager(self.opt.get_int("undo_levels"))
+        self.urm = UndoRedoManager(self.opt.get_int("undo_levels"),
+            self.opt.get_int("undo_memory"))
         self.macros = MacroManager.new_from_string(self.opt.get_str("macros"))
-        self.last_undo_cnt = 0
+        self.replaying = False      # Applying an undo or redo
+        self.loading_page = None    # Name of the page being loaded
         self.formatTimerID = None
         self.saveTimerID = None
+        self.syncTimerID = None
+        self.dirty_start = None     # Marks around the text not formatted
+        self.dirty_end = None
+        self.dirty_code = False     # Code blocks may have changed too
+        self.formatIdleID = None
+        self.format_pending = [ ]   # Pairs of marks around unformatted text
+        self.format_source = None   # Text, code blocks, etc. of the above
+        self.span_cache = markup.SpanCache(SkedApp.SPAN_CACHE_SIZE)
         self.window_state = 0
         self.evtags = [ ]   # TextTags that triggers link events
         self.history = HistoryManager(self.db, "history",
@@ -233,11 +250,22 @@ class SkedApp(interface.BaseDialog):
     def update_options(self):
         self.format_time = 1000 * self.opt.get_int("format_time")
         self.save_time = 1000 * self.opt.get_int("save_time")
+        policy = self.opt.get_str("sync_policy")
+        if policy not in database.EncryptedDatabase.SYNC_POLICIES:
+            policy = database.EncryptedDatabase.SYNC_ALWAYS
+        self.db.sync_policy = policy
+        self.db.sync_interval = max(1, self.opt.get_int("sync_interval"))
+        self.pm.keep_revisions = self.opt.get_bool("keep_revisions")
+        self.pm.revisions.max_count = max(1, self.opt.get_int("max_revisions"))
+        self.pm.revisions.max_age = 24 * 3600 * \
+            self.opt.get_int("revision_days")
         self.macros.load_string(self.opt.get_str("macros"))
         self._update_sidebar()
         self._set_edit_buttons()
         self.set_text_tags()
-        self.format_text()
+        rect = self.txNote.get_visible_rect()
+        top = self.txNote.get_iter_at_location(rect.x, rect.y).get_offset()
+        self.format_page(top + SkedApp.FORMAT_VISIBLE / 2)
         
     def _update_sidebar(self):
         show_sidebar = self.opt.get_bool("show_sidebar")
@@ -356,8 +384,9 @@ class SkedApp(interface.BaseDialog):
             self._on_text_change)
         self.text_delete_sigid = self.txBuffer.connect("delete-range",
             self._on_text_delete)
+        self.text_insert_sigid = self.txBuffer.connect_after("insert-text",
+            self._on_text_insert)
     
-        self.mnLevenshtein.set_property("sensitive", HAVE_LEVENSHTEIN)
         display = gdk.display_manager_get().get_default_display()
         self.clipboard = gtk.Clipboard(display, "CLIPBOARD")
         self.set_text_tags()
@@ -410,8 +439,6 @@ class SkedApp(interface.BaseDialog):
         ret = interface.confirm_yes_no(self.window,
             u'Delete the page "' + pagename + u'" forever?')
         if ret:
-            self.urm.clear()
-            self.last_undo_cnt = 0
             lastpage = self.bfm.back() or INDEX_PAGE
             self.hl_change_page(lastpage)
             self.pm.delete(pagename)
@@ -539,18 +566,19 @@ class SkedApp(interface.BaseDialog):
                 "You must select a search mode.")
             return
         if mode == PageManager.SEARCH_LEVENSHTEIN:
-            if not HAVE_LEVENSHTEIN:
-                interface.error_dialog(self.window,
-                    "Similarity search is not available in your system")
-                return
             results = self.pm.levenshtein_search(terms)
             self.gsearch_model.clear()
             for res in results:
                 self.gsearch_model.append([ res ])
             return
         self.gsearch_model.clear()
-        self.pm.search(terms, mode, False, self.mnFullText.get_active(),
-            False, self._gsearch_add_page_and_update)
+        if self.mnFullText.get_active():
+            self.pm.search(terms, mode, False, True, False,
+                self._gsearch_add_page_and_update)
+        else:
+            # Only the names are shown, so no page is loaded.
+            for name in self.pm.search_names(terms, mode):
+                self.gsearch_model.append([ name ])
 
     def on_cmd_sort_lines(self, widget = None, data = None):
         smark = self.txBuffer.get_selection_bound()
@@ -647,7 +675,6 @@ class SkedApp(interface.BaseDialog):
         pagename = self.bfm.back()
         if pagename:
             self.change_page(pagename)
-            self.mark_page_on_calendar()
         self._update_back_forward()
 
     def on_cmd_eval_macro(self, widget = None, data = None):
@@ -688,7 +715,6 @@ class SkedApp(interface.BaseDialog):
         pagename = self.bfm.forward()
         if pagename:
             self.change_page(pagename)
-            self.mark_page_on_calendar()
         self._update_back_forward()
         
     def on_cmd_paste(self, widget = None, data = None):
@@ -700,9 +726,9 @@ class SkedApp(interface.BaseDialog):
         wnd.show()
         
     def on_cmd_redo(self, widget = None, data = None):
-        page = self.urm.redo()
-        if page:
-            self.set_page(page)
+        delta = self.urm.redo()
+        if delta:
+            self._replay(delta)
 
     def on_cmd_rename_page(self, widget = None, data = None):
         dlg = interface.RenamePageDialog(self)
@@ -747,9 +773,9 @@ class SkedApp(interface.BaseDialog):
         self.hl_change_page("%04d-%02d-%02d" % (dt.year, dt.month, dt.day))
         
     def on_cmd_undo(self, widget = None, data = None):
-        page = self.urm.undo()
-        if page:
-            self.set_page(page)
+        delta = self.urm.undo()
+        if delta:
+            self._replay(delta)
 
     def on_cmd_yesterday(self, widget = None, data = None):
         dt = datetime.datetime.today() - datetime.timedelta(1)
@@ -786,22 +812,64 @@ class SkedApp(interface.BaseDialog):
         return True
 
     def _on_text_change(self, widget = None, data = None):
-        # Add an undo-point if the text was changed 10 times.
-        self.last_undo_cnt += 1
-        if self.last_undo_cnt >= 10:
-            self.store_undo_state()
-            self.last_undo_cnt = 0
+        self._update_undo_redo()
         self.reset_timers()
         self.set_timers()
         self.set_status(u'Page "' + self.curpage.name + u'" changed')
 
     def _on_text_delete(self, widget = None, s = None, e = None, dt = None):
-        # big amount of text being deleted? Prepare for undo!
-        if abs(s.get_offset() - e.get_offset()) > 10:
-            self.store_undo_state()
-        
+        # Called before the deletion, so the text deleted is still there.
+        if not self.replaying:
+            self.urm.delete(s.get_offset(),
+                self.txBuffer.get_text(s, e).decode("utf-8"))
+        if self._touches_code(s, e):
+            self.dirty_code = True
+        self._mark_dirty(s, e)
+
+    def _on_text_insert(self, widget = None, iter = None, text = None,
+    length = None):
+        # Called after the insertion, 'iter' is at the end of the new text.
+        text = text.decode("utf-8")
+        start = iter.copy()
+        start.backward_chars(len(text))
+        if not self.replaying:
+            self.urm.insert(start.get_offset(), text)
+        if self._touches_code(start, iter):
+            self.dirty_code = True
+        self._mark_dirty(start, iter)
+
+    def _touches_code(self, start, end):
+        # Whether changing the text between start and end may create or
+        # break a "|||", opening or closing a code block.
+        start = start.copy()
+        start.backward_chars(2)
+        end = end.copy()
+        end.forward_chars(2)
+        return "|" in self.txBuffer.get_text(start, end)
+
+    def _mark_dirty(self, start, end):
+        # Extends the range of text to be formatted again. Marks keep it
+        # valid while the text changes.
+        self.format_source = None
+        if self.dirty_start == None:
+            self.dirty_start = self.txBuffer.create_mark(None, start, True)
+            self.dirty_end = self.txBuffer.create_mark(None, end, False)
+            return
+        if start.compare(self.txBuffer.get_iter_at_mark(self.dirty_start)) < 0:
+            self.txBuffer.move_mark(self.dirty_start, start)
+        if end.compare(self.txBuffer.get_iter_at_mark(self.dirty_end)) > 0:
+            self.txBuffer.move_mark(self.dirty_end, end)
+
+    def _clear_dirty(self):
+        if self.dirty_start != None:
+            self.txBuffer.delete_mark(self.dirty_start)
+            self.txBuffer.delete_mark(self.dirty_end)
+            self.dirty_start = None
+            self.dirty_end = None
+        self.dirty_code = False
+
     def _on_format_timer(self):
-        self.format_text()
+        self.format_changes()
         gobject.source_remove(self.formatTimerID)
         self.formatTimerID = None
         return False    # Stops the timer
@@ -812,6 +880,23 @@ class SkedApp(interface.BaseDialog):
         self.saveTimerID = None
         return False    # Stops the timer
         
+    def _on_sync_timer(self):
+        self.db.sync(True)
+        self.syncTimerID = None
+        return False    # Stops the timer
+
+    def schedule_sync(self):
+        # Makes the deferred writes durable when the sync policy requires:
+        # once the main loop is idle or after the sync interval.
+        if self.syncTimerID != None:
+            return
+        policy = self.db.sync_policy
+        if policy == database.EncryptedDatabase.SYNC_ON_IDLE:
+            self.syncTimerID = gobject.idle_add(self._on_sync_timer)
+        elif policy == database.EncryptedDatabase.SYNC_INTERVAL:
+            self.syncTimerID = gobject.timeout_add(
+                1000 * self.db.sync_interval, self._on_sync_timer)
+
     def set_timers(self):
         if not self.format_time:
             self.format_time = 1000 * self.opt.get_int("format_time")
@@ -865,11 +950,14 @@ class SkedApp(interface.BaseDialog):
         return self.txBuffer.get_text(start, end).decode("utf-8")
 
     def set_text(self, text):
+        self._cancel_format()
         self.txBuffer.handler_block(self.text_change_sigid)
         self.txBuffer.handler_block(self.text_delete_sigid)
+        self.txBuffer.handler_block(self.text_insert_sigid)
         self.txBuffer.set_text(text)
         self.txBuffer.handler_unblock(self.text_change_sigid)
         self.txBuffer.handler_unblock(self.text_delete_sigid)
+        self.txBuffer.handler_unblock(self.text_insert_sigid)
 
     def insert_formatting(self, before, after):
         smark = self.txBuffer.get_selection_bound()
@@ -988,92 +1076,187 @@ class SkedApp(interface.BaseDialog):
                 self.evtags.append(tag)
 
     def format_text(self):
+        # Formats the entire text again.
+        self._cancel_format()
+        self._clear_dirty()
+        tx = self.get_text()
+        self._format_region(tx, 0, len(tx))
+
+    def format_page(self, offset, key = None):
+        # Formats the text around the given offset (about the middle of
+        # the text shown) at once, the remaining text when idle. If 'key'
+        # (the hash of the text) is given, the tag spans are cached and
+        # the text is not parsed again while the existing pages are the
+        # same.
+        self._cancel_format()
+        self._clear_dirty()
         tx = self.get_text()
-        start, end = self.txBuffer.get_bounds() # Apply defaults
+        spans = None
+        pieces = None
+        if key != None:
+            spans = self.span_cache.get(key, self.pm.names_generation)
+            if spans == None:
+                pieces = [ ]
+        if len(tx) <= SkedApp.FORMAT_VISIBLE:
+            spans = self._format_region(tx, 0, len(tx), spans)
+            if pieces != None:
+                self.span_cache.put(key, spans, self.pm.names_generation)
+            return
+        blocks = markup.code_blocks(tx)
+        rstart, rend = markup.expand_region(blocks, tx,
+            max(0, offset - SkedApp.FORMAT_VISIBLE / 2),
+            min(len(tx), offset + SkedApp.FORMAT_VISIBLE / 2))
+        start, end = self.txBuffer.get_bounds()
+        self.txBuffer.apply_tag_by_name("std", start, end)
+        piece = self._format_region(tx, rstart, rend, spans)
+        if pieces != None:
+            pieces.append((rstart, piece))
+        # The text after the visible part comes first.
+        for pstart, pend in ((rend, len(tx)), (0, rstart)):
+            if pstart < pend:
+                self._format_later(pstart, pend)
+        if len(self.format_pending) > 0:
+            self.format_source = (tx, blocks, spans, pieces, key)
+        elif pieces != None:
+            self._cache_spans(key, pieces)
+
+    def _format_later(self, pstart, pend):
+        # Adds the text between pstart and pend to the text formatted when
+        # idle.
+        self.format_pending.append((
+            self.txBuffer.create_mark(None,
+                self.txBuffer.get_iter_at_offset(pstart), True),
+            self.txBuffer.create_mark(None,
+                self.txBuffer.get_iter_at_offset(pend), False)))
+        if self.formatIdleID == None:
+            self.formatIdleID = gobject.idle_add(self._on_format_idle)
+
+    def _on_format_idle(self):
+        # Formats chunks of the pending text until the time slice ends. If
+        # the text was not changed, the spans of the whole text are cached
+        # in the end.
+        deadline = time.time() + SkedApp.FORMAT_SLICE
+        if self.format_source == None:  # The text was changed.
+            tx = self.get_text()
+            self.format_source = (tx, markup.code_blocks(tx), None, None,
+                None)
+        tx, blocks, spans, pieces, key = self.format_source
+        while len(self.format_pending) > 0:
+            smark, emark = self.format_pending[0]
+            start = self.txBuffer.get_iter_at_mark(smark).get_offset()
+            end = self.txBuffer.get_iter_at_mark(emark).get_offset()
+            if start >= end:
+                self.txBuffer.delete_mark(smark)
+                self.txBuffer.delete_mark(emark)
+                self.format_pending.pop(0)
+                continue
+            # Chunks are whole lines, so the next one starts where this one
+            # ends unless the text was changed.
+            rstart, rend = markup.expand_region(blocks, tx, start,
+                min(end, start + SkedApp.FORMAT_CHUNK))
+            piece = self._format_region(tx, rstart, rend, spans)
+            if pieces != None:
+                pieces.append((rstart, piece))
+            self.txBuffer.move_mark(smark,
+                self.txBuffer.get_iter_at_offset(rend))
+            if time.time() >= deadline:
+                break
+        if len(self.format_pending) > 0:
+            return True
+        if pieces != None:
+            self._cache_spans(key, pieces)
+        self.formatIdleID = None
+        self.format_source = None
+        return False    # Everything formatted
+
+    def _cache_spans(self, key, pieces):
+        # Caches the spans of the whole text, given as (start, spans) for
+        # the parts formatted, which do not overlap.
+        pieces.sort()
+        spans = [ ]
+        for rstart, piece in pieces:
+            spans.extend(piece)
+        self.span_cache.put(key, spans, self.pm.names_generation)
+
+    def _cancel_format(self):
+        # Stops formatting the text when idle.
+        if self.formatIdleID != None:
+            gobject.source_remove(self.formatIdleID)
+            self.formatIdleID = None
+        for smark, emark in self.format_pending:
+            self.txBuffer.delete_mark(smark)
+            self.txBuffer.delete_mark(emark)
+        self.format_pending = [ ]
+        self.format_source = None
+
+    def format_changes(self):
+        # Formats again only the lines changed since the last formatting.
+        # A change in the "|||" delimiters may open or close code blocks up
+        # to the end of the text: the code block reaching past the changes
+        # is formatted at once, the text after it when idle.
+        if self.dirty_start == None:
+            return
+        start = self.txBuffer.get_iter_at_mark(self.dirty_start)
+        end = self.txBuffer.get_iter_at_mark(self.dirty_end)
+        code = self.dirty_code
+        self._clear_dirty()
+        start.set_line_offset(0)
+        if not end.ends_line():
+            end.forward_to_line_end()
+        if code:
+            # Back to the start of the code block that was formatted before
+            # the region, the text there was not changed.
+            tag = self.txBuffer.get_tag_table().lookup("code")
+            prev = start.copy()
+            if prev.backward_char() and prev.has_tag(tag):
+                prev.backward_to_tag_toggle(tag)
+                prev.set_line_offset(0)
+                start = prev
+        tx = self.get_text()
+        rstart = start.get_offset()
+        rend = end.get_offset()
+        rstart, rend = markup.expand_region(markup.code_blocks(tx), tx,
+            rstart, rend)
+        self._format_region(tx, rstart, rend)
+        if code and rend < len(tx):
+            self._format_later(rend, len(tx))
+
+    def _format_region(self, tx, rstart, rend, spans = None):
+        # Formats the text between rstart and rend, starting on a line,
+        # with the tag spans of the entire text, if given, or the ones
+        # found in the region. Returns the spans applied.
+        start = self.txBuffer.get_iter_at_offset(rstart) # Apply defaults
+        end = self.txBuffer.get_iter_at_offset(rend)
         self.txBuffer.remove_all_tags(start, end)
         self.txBuffer.apply_tag_by_name("std", start, end)
-
-        h_re = ur"^\s*(=+)(.+?)(=+)\s*$"        # === Headings ===
-        for match in re.finditer(h_re, tx, re.MULTILINE):
-            cntl = len(match.group(1))
-            cntr = len(match.group(3))
-            if cntl == cntr and cntl == 3:
-                h = "h1"
-            elif cntl == cntr and cntl == 2:
-                h = "h2"
-            elif cntl == cntr and cntl == 1:
-                h = "h3"
-            else:
-                h = None
-            if h != None:
-                self._apply_tag_on_group(match, "format", 1)
-                self._apply_tag_on_group(match, h, 2)
-                self._apply_tag_on_group(match, "format", 3)
-
-        bold_re = ur"\W(\*+)([^*\n\r]+?)(\*+)\W"    # *bold*
-        for match in re.finditer(bold_re, tx):
-            self._apply_tag_on_group(match, "format", 1)
-            self._apply_tag_on_group(match, "bold", 2)
-            self._apply_tag_on_group(match, "format", 3)
-        
-        italic_re = ur"\W(//+)([^/\n\r]+?)(//+)\W"  # //italic//
-        for match in re.finditer(italic_re, tx):
-            self._apply_tag_on_group(match, "format", 1)
-            self._apply_tag_on_group(match, "italic", 2)
-            self._apply_tag_on_group(match, "format", 3)
-        
-        underl_re = ur"\W(_+)([^_\n\r]+?)(_+)\W"    # _underline_
-        for match in re.finditer(underl_re, tx):
-            self._apply_tag_on_group(match, "format", 1)
-            self._apply_tag_on_group(match, "underline", 2)
-            self._apply_tag_on_group(match, "format", 3)
-
-        link_re = ur"(\[\[ *)(.+?)( *\]\])" # [[Link]]
-        for match in re.finditer(link_re, tx):
-            if self.pm.exists(match.group(2)):
-                style = "link"
-            else:
-                style = "newlink"
-            self._apply_tag_on_group(match, "format", 1)
-            self._apply_tag_on_group(match, style, 2)
-            self._apply_tag_on_group(match, "format", 3)
-
-        url_re = ur"(([a-zA-Z]+://|www\.)[^\s<>\"'\[\]]+[^\s>\"'\)\[\].,;?!]+)" # url
-        for match in re.finditer(url_re, tx):
-            self._apply_tag_on_group(match, "url", 1)
-
-        code_re = ur"(\|\|\|)(.+?)(\|\|\|)" # |||code|||
-        for match in re.finditer(code_re, tx, re.MULTILINE| re.DOTALL):
-            self._apply_tag_on_group(match, "format", 1)
-            self._apply_tag_on_group(match, "code", 2)
-            self._apply_tag_on_group(match, "format", 3)
-
-        link_re = ur"([0-3]?[0-9])\/([01]?[0-9])\/([0-9]{1,4})"
-        for match in re.finditer(link_re, tx):
-            if self.pm.exists(self.reformat_page_name(match.group(0))):
-                self._apply_tag_on_group(match, "datelink", 0)
-            else:
-                self._apply_tag_on_group(match, "newdatelink", 0)
-
-        link_re = ur"([0-9]{1,4})-([01]?[0-9])-([0-3]?[0-9])"
-        for match in re.finditer(link_re, tx):
-            if self.pm.exists(match.group(0)):
-                self._apply_tag_on_group(match, "datelink", 0)
-            else:
-                self._apply_tag_on_group(match, "newdatelink", 0)
-
-    def _apply_tag_on_group(self, match, tag, group):
-        start = self.txBuffer.get_iter_at_offset(match.start(group))
-        end = self.txBuffer.get_iter_at_offset(match.end(group))
-        self.txBuffer.apply_tag_by_name(tag, start, end)
+        if spans == None:
+            spans = tag_spans(markup.parse(tx, rstart, rend), self.pm.exists)
+        else:
+            spans = spans[bisect.bisect_left(spans, (rstart, )):
+                bisect.bisect_left(spans, (rend, ))]
+        apply_spans(self.txBuffer, spans)
+        return spans
 
     def get_date_str(self):
         year, month, day = self.calendar.get_date()
         return "%04d-%02d-%02d" % (year, month + 1, day)
 
-    def store_undo_state(self):
-        self.capture_page_state()
-        self.urm.enqueue(self.curpage)
+    def _replay(self, delta):
+        # Applies a delta given by the undo manager to the text, without
+        # recording it as a change, and puts the cursor after it.
+        offset, removed, inserted = delta
+        start = self.txBuffer.get_iter_at_offset(offset)
+        end = self.txBuffer.get_iter_at_offset(offset + len(removed))
+        self.replaying = True
+        try:
+            if len(removed) > 0:
+                self.txBuffer.delete(start, end)    # Revalidates 'start'
+            if len(inserted) > 0:
+                self.txBuffer.insert(start, inserted)
+        finally:
+            self.replaying = False
+        self.txBuffer.place_cursor(start)
+        self.txNote.scroll_to_mark(self.txBuffer.get_insert(), 0.25)
         self._update_undo_redo()
 
     def hl_change_page(self, pagename):
@@ -1085,41 +1268,73 @@ class SkedApp(interface.BaseDialog):
         self.change_page(pagename)
         self._update_back_forward()
         self._update_undo_redo()
-        self.mark_page_on_calendar()
 
     def change_page(self, pagename):
         self.reset_timers()
         self.save_current_page()
         pagename = self.reformat_page_name(pagename)
-        page = self.pm.load(pagename)
+        # The page is read by the database worker; only the last page asked
+        # for is shown.
+        self.loading_page = pagename
+        self.pm.load_async(pagename,
+            lambda page: self._on_page_loaded(pagename, page),
+            gobject.idle_add)
+
+    def _on_page_loaded(self, pagename, page):
+        if pagename != self.loading_page:
+            return
+        self.loading_page = None
+        if self.txBuffer.get_modified():
+            # Edited while the page was being loaded.
+            self.save_current_page()
         if not page:
             page = Page(pagename, "")
         self.history.add(page.name)
         self.set_page(page)
-        self.urm.clear()
-        self.last_undo_cnt = 0
+        self.mark_page_on_calendar()
 
     def set_page(self, page):
         self.curpage = page
         self.txPageName.set_text(self.curpage.name)
         self.set_text(page.text)
+        self.urm.clear()    # The changes recorded are for the old text
+        self.txBuffer.set_modified(False)
         cursor_iter = self.txBuffer.get_iter_at_offset(page.cursor_pos)
         self.txBuffer.place_cursor(cursor_iter)
-        self.txNote.scroll_to_mark(self.txBuffer.get_insert(), 0.25)
-        self.format_text()
+        if page.scroll_pos != None:
+            # Restores the first visible line.
+            top = self.txBuffer.get_iter_at_offset(page.scroll_pos)
+            mark = self.txBuffer.create_mark(None, top, True)
+            self.txNote.scroll_to_mark(mark, 0.0, True, 0.0, 0.0)
+            self.txBuffer.delete_mark(mark)
+        else:
+            self.txNote.scroll_to_mark(self.txBuffer.get_insert(), 0.25)
+        # The view is not laid out yet, so the text shown is estimated.
+        if page.scroll_pos != None:
+            self.format_page(page.scroll_pos + SkedApp.FORMAT_VISIBLE / 2,
+                page.text_hash())
+        else:
+            self.format_page(page.cursor_pos, page.text_hash())
         self.set_status(page.name)
         self._update_undo_redo()
 
     def capture_page_state(self):
         # Captures current interface state to 'curpage'
         if not self.curpage: return
-        self.curpage.text = self.get_text()
+        # The text is only copied if it was edited since the last capture.
+        if self.txBuffer.get_modified():
+            self.curpage.text = self.get_text()
+            self.txBuffer.set_modified(False)
         self.curpage.cursor_pos = self.txBuffer.get_property("cursor-position")
+        rect = self.txNote.get_visible_rect()
+        self.curpage.scroll_pos = \
+            self.txNote.get_iter_at_location(rect.x, rect.y).get_offset()
 
     def save_current_page(self):
         if not self.curpage: return
         self.capture_page_state()
-        self.pm.save(self.curpage)
+        if self.pm.save(self.curpage):
+            self.schedule_sync()
         self.set_status(u'Page "' + self.curpage.name + u'" saved')
 
     def reload_current_page(self):
@@ -1175,9 +1390,8 @@ class SkedApp(interface.BaseDialog):
             mdays = ( 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31 )
 
         self.calendar.clear_marks()
-        for day in range(1, mdays[month] + 1):
-            pagename = "%04d-%02d-%02d" % (year, month + 1, day)
-            if self.pm.exists(pagename):
+        for day in self.pm.month_days(year, month + 1):
+            if day <= mdays[month]:
                 self.calendar.mark_day(day)
 
     def add_link_brackets_if_needed(self, name):
@@ -1323,6 +1537,7 @@ class SkedXmlDataHandler(object):
             self.app.history.load()
             self.app.opt.load()
             self.app.update_options()
+            self.app.schedule_sync()
         except xmlio.VersionError, e:
             interface.error_dialog(dlg, u"The file selected was generated "
                 "by an unsupported version of Sked")
@@ -1411,10 +1626,18 @@ def main(dbpath = None):
             if pwd == None:
                 db.release_lock()
                 return
+        if db.access_method != database.EncryptedDatabase.ACCESS_BTREE:
+            # Databases created by older versions are hashes, which can
+            # not be scanned by key prefix.
+            db.convert(pwd, database.EncryptedDatabase.ACCESS_BTREE)
 
     if db.is_ready:
+        # The database is written by a worker thread, so saving never
+        # blocks the interface; all changes are flushed by 'close'.
+        gobject.threads_init()
+        adb = database.AsyncDatabase(db)
         try:
-            app = SkedApp(db, db.path if show_db_path else None)
+            app = SkedApp(adb, db.path if show_db_path else None)
             try:
                 if HAVE_DBUS:
                     app.bus_ctl = skeddbus.Controller(app, instance_name)
@@ -1424,7 +1647,7 @@ def main(dbpath = None):
         except Exception, e:
             print(e)
         finally:
-            db.close()
+            adb.close()
     else:
         interface.error_dialog(None, u"Can not open the database. Namárië.")
         db.release_lock()
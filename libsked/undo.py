@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+# Sked - a wikish scheduler with Python and PyGTK
+# (c) 2006-10 Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA.
+
+"""
+Undo and redo.
+
+The changes made to the text of a page are kept as deltas, tuples (offset,
+removed, inserted) with the text removed at the offset and the text inserted
+in its place.
+"""
+
+import records
+
+
+# Texts are compared by blocks of this size before finding where they differ,
+# as comparing strings is much faster than comparing characters in Python.
+_BLOCK = 1024
+
+
+def diff(old, new):
+    """ Returns the delta changing the text 'old' into 'new'. Only the common
+    start and end of the texts are left out, which is enough for the changes
+    made by editing a page. """
+    size = min(len(old), len(new))
+    start = _common_prefix(old, new, size)
+    end = _common_suffix(old, new, size - start)
+    return (start, old[start:len(old) - end], new[start:len(new) - end])
+
+
+def patch(text, delta):
+    """ Returns the text changed by the given delta. """
+    offset, removed, inserted = delta
+    return text[:offset] + inserted + text[offset + len(removed):]
+
+
+def _common_prefix(a, b, size):
+    pos = 0
+    while pos < size:
+        count = min(_BLOCK, size - pos)
+        if a[pos:pos + count] != b[pos:pos + count]:
+            break
+        pos += count
+    while pos < size and a[pos] == b[pos]:
+        pos += 1
+    return pos
+
+
+def _common_suffix(a, b, size):
+    alen = len(a)
+    blen = len(b)
+    n = 0
+    while n < size:
+        count = min(_BLOCK, size - n)
+        if a[alen - n - count:alen - n] != b[blen - n - count:blen - n]:
+            break
+        n += count
+    while n < size and a[alen - n - 1] == b[blen - n - 1]:
+        n += 1
+    return n
+
+
+class _DeltaList(object):
+    # A list of deltas, oldest first; the oldest ones may be packed as
+    # records. 'size' is the number of characters of the deltas not packed
+    # plus the bytes of the packed ones.
+
+    def __init__(self):
+        self._deltas = [ ]
+        self._packed = 0        # Number of packed deltas
+        self.size = 0
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def top(self):
+        # Returns the newest delta or None if it is packed.
+        if len(self._deltas) == 0 or self._packed == len(self._deltas):
+            return None
+        return self._deltas[-1]
+
+    def push(self, delta):
+        self._deltas.append(delta)
+        self.size += _delta_size(delta)
+
+    def pop(self):
+        delta = self._deltas.pop()
+        self.size -= _delta_size(delta)
+        if isinstance(delta, str):
+            delta = records.decode(delta)
+            self._packed -= 1
+        return delta
+
+    def pack_oldest(self):
+        # Packs the oldest delta not packed yet. Returns False if all of
+        # them are packed.
+        if self._packed == len(self._deltas):
+            return False
+        delta = self._deltas[self._packed]
+        packed = records.encode(delta)
+        self._deltas[self._packed] = packed
+        self.size += len(packed) - _delta_size(delta)
+        self._packed += 1
+        return True
+
+    def drop_oldest(self):
+        self.size -= _delta_size(self._deltas.pop(0))
+        if self._packed > 0:
+            self._packed -= 1
+
+
+def _delta_size(delta):
+    if isinstance(delta, str):
+        return len(delta)
+    return len(delta[1]) + len(delta[2])
+
+
+class UndoRedoManager(object):
+    """ Keeps the changes made to the text of a page for undo and redo, as
+    deltas. Characters typed or deleted one by one are grouped by words, so
+    they are undone together. Up to 'max_levels' changes can be undone; if
+    the memory used goes over 'max_bytes' (taking a character of text as a
+    byte), the oldest changes are compressed and, if it is not enough,
+    dropped. They are uncompressed as needed. """
+
+    def __init__(self, max_levels = 1000, max_bytes = 4 * 1024 * 1024):
+        self.max_levels = max_levels
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        self._undol = _DeltaList()
+        self._redol = _DeltaList()
+        self._grouping = False  # If the last change may be extended
+
+    def clear_redo(self):
+        self._redol = _DeltaList()
+
+    def close_group(self):
+        """ Makes the next change a new one, even if it continues the text
+        typed or deleted in the last one. """
+        self._grouping = False
+
+    def insert(self, offset, text):
+        """ Records the insertion of 'text' at the given offset. """
+        self._record((offset, u"", text))
+
+    def delete(self, offset, text):
+        """ Records the deletion of 'text' from the given offset. """
+        self._record((offset, text, u""))
+
+    def undo(self):
+        """ Returns the delta that undoes the last change when applied to
+        the text, or None if there is nothing to undo. """
+        if not self.can_undo():
+            return None
+        self._grouping = False
+        delta = self._undol.pop()
+        self._redol.push(delta)
+        self._trim()
+        return (delta[0], delta[2], delta[1])
+
+    def redo(self):
+        """ Returns the delta that redoes the last change undone when applied
+        to the text, or None if there is nothing to redo. """
+        if not self.can_redo():
+            return None
+        self._grouping = False
+        delta = self._redol.pop()
+        self._undol.push(delta)
+        self._trim()
+        return delta
+
+    def can_undo(self):
+        return len(self._undol) > 0
+
+    def can_redo(self):
+        return len(self._redol) > 0
+
+    def size(self):
+        """ Returns the memory used, as counted for 'max_bytes'. """
+        return self._undol.size + self._redol.size
+
+    def _record(self, delta):
+        self.clear_redo()
+        typed = len(delta[1]) + len(delta[2]) == 1
+        last = self._undol.top()
+        if self._grouping and typed and last != None:
+            merged = _merge_typing(last, delta)
+            if merged != None:
+                self._undol.pop()
+                delta = merged
+        self._undol.push(delta)
+        self._grouping = typed
+        self._trim()
+
+    def _trim(self):
+        while len(self._undol) > self.max_levels:
+            self._undol.drop_oldest()
+        while self.size() > self.max_bytes:
+            if self._undol.pack_oldest() or self._redol.pack_oldest():
+                continue
+            if len(self._undol) > 0:
+                self._undol.drop_oldest()
+            elif len(self._redol) > 0:
+                self._redol.drop_oldest()
+            else:
+                break
+
+
+def _merge_typing(last, delta):
+    # Returns the change 'last' extended by 'delta', a single character,
+    # if both insert or delete text next to each other and 'delta' does not
+    # start a new word, or None.
+    offset, removed, inserted = delta
+    if len(last[1]) == 0 and len(removed) == 0:
+        if offset == last[0] + len(last[2]) \
+        and not _new_word(last[2][-1], inserted):
+            return (last[0], u"", last[2] + inserted)
+    elif len(last[2]) == 0 and len(inserted) == 0:
+        if offset + 1 == last[0] and not _new_word(last[1][0], removed):
+            return (offset, removed + last[1], u"")     # Backspace
+        if offset == last[0] and not _new_word(last[1][-1], removed):
+            return (offset, last[1] + removed, u"")     # Delete
+    return None
+
+
+def _new_word(last, char):
+    # If the character typed or deleted after 'last' starts a new word.
+    return last.isspace() and not char.isspace()
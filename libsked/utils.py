@@ -75,3 +75,77 @@ def rename_file(oldn, newn):
                 raise exc
     # Rename the file.
     os.rename(oldn, newn)
+
+
+class LRUCache(object):
+    """ Least recently used cache bounded by the total size of its values,
+    as measured by the function 'size_func'. Values larger than 'max_size'
+    are not cached. The number of cache hits and misses are kept in the
+    properties 'hits' and 'misses'.
+    """
+
+    def __init__(self, max_size, size_func):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._size_func = size_func
+        # The entries are [ previous, next, key, value, size ] lists kept in
+        # a circular list, from the least to the most recently used.
+        self._entries = { }
+        self._root = [ None, None, None, None, 0 ]
+        self._root[0] = self._root[1] = self._root
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """ Returns the value cached for 'key' or None. """
+        entry = self._entries.get(key)
+        if entry == None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(entry)
+        self._link(entry)
+        return entry[3]
+
+    def put(self, key, value):
+        """ Caches 'value' as 'key', dropping the least recently used values
+        if needed. """
+        self.remove(key)
+        size = self._size_func(value)
+        if size > self.max_size:
+            return
+        entry = [ None, None, key, value, size ]
+        self._entries[key] = entry
+        self._link(entry)
+        self.size += size
+        while self.size > self.max_size:
+            self.remove(self._root[1][2])
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry != None:
+            self._unlink(entry)
+            self.size -= entry[4]
+
+    def clear(self):
+        self._entries = { }
+        self._root[0] = self._root[1] = self._root
+        self.size = 0
+
+    def _link(self, entry):
+        # Inserts the entry as the most recently used.
+        last = self._root[0]
+        entry[0] = last
+        entry[1] = self._root
+        last[1] = entry
+        self._root[0] = entry
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
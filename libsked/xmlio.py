@@ -60,6 +60,9 @@ class SkedContentHandler(ContentHandler):
     IN_ENTRY = 7
     DONE = 9
 
+    # Number of pages saved at once.
+    PAGE_BUFFER_SIZE = 500
+
     import_pages = True
     import_config = True
     import_history = True
@@ -71,6 +74,7 @@ class SkedContentHandler(ContentHandler):
         if self._pm == None: self.import_pages = False
         if self._opt == None: self.import_config = False
         self._state = SkedContentHandler.READY
+        self._pages = [ ]
 
     def startDocument(self):
         self._state = SkedContentHandler.WAITING_SKEDDATA
@@ -78,6 +82,12 @@ class SkedContentHandler(ContentHandler):
     def endDocument(self):
         if self._state != SkedContentHandler.DONE:
             raise PrematureDocumentEndError
+        self._save_pages()
+
+    def _save_pages(self):
+        if len(self._pages) > 0:
+            self._pm.save_many(self._pages)
+            self._pages = [ ]
 
     def startElement(self, name, attrs):
         if self._state == SkedContentHandler.WAITING_SKEDDATA \
@@ -102,7 +112,7 @@ class SkedContentHandler(ContentHandler):
             self._tmp_name = attrs.get("name")
             if len(self._tmp_name) < 1:
                 raise DataFormatError("Empty page name")
-            self._tmp_data = ""
+            self._tmp_data = [ ]
             self._state = SkedContentHandler.IN_ENTRY
 
         elif self._state == SkedContentHandler.IN_CONFIG \
@@ -151,7 +161,10 @@ class SkedContentHandler(ContentHandler):
         elif self._state == SkedContentHandler.IN_ENTRY \
         and name == "entry":
             if self.import_pages:
-                self._pm.save(Page(self._tmp_name, self._tmp_data), False)
+                self._pages.append(Page(self._tmp_name,
+                    u"".join(self._tmp_data)))
+                if len(self._pages) >= SkedContentHandler.PAGE_BUFFER_SIZE:
+                    self._save_pages()
             self._tmp_name = None
             self._tmp_data = None
             self._state = SkedContentHandler.IN_SKEDDATA
@@ -163,9 +176,11 @@ class SkedContentHandler(ContentHandler):
 
     def characters(self, data):
         if self._state == SkedContentHandler.IN_CONFIG_OPTION \
-        or self._state == SkedContentHandler.IN_HISTORY_ITEM \
-        or self._state == SkedContentHandler.IN_ENTRY:
+        or self._state == SkedContentHandler.IN_HISTORY_ITEM:
             self._tmp_data = self._tmp_data + data
+        elif self._state == SkedContentHandler.IN_ENTRY:
+            # Entries may be long and come in many pieces.
+            self._tmp_data.append(data)
 
 
 
@@ -182,7 +197,8 @@ def import_xml_file(fname, db, page_manager, option_manager, import_history):
     'option_manager' is an instance of OptionManager using 'db' as its
     backend or None (implies in not importing the configuration from the file).
     'import_history' is a boolean which controls the importing of any history
-    entries existing in the file.
+    entries existing in the file. All data is written in a single database
+    batch, so nothing is imported if the file has some error.
     """
     ch = SkedContentHandler(db, page_manager, option_manager)
     ch.import_history = import_history
@@ -190,8 +206,17 @@ def import_xml_file(fname, db, page_manager, option_manager, import_history):
     parser.setContentHandler(ch)
     parser.setEntityResolver(SkedEntityResolver())
     fp = open(fname, "rb")
-    parser.parse(fp)
-    fp.close()
+    try:
+        try:
+            with db.batch():
+                parser.parse(fp)
+        except:
+            # The pages saved before the error were rolled back.
+            if page_manager != None:
+                page_manager.reset()
+            raise
+    finally:
+        fp.close()
 
 def export_xml_file(fname, page_manager, option_manager, histories):
     """ Exports Sked data to the XML file 'fname'. 'option_manager' is an
@@ -5,20 +5,35 @@ import unittest
 
 import os
 import random
+import threading
+import time
+import zlib
+import cPickle
+import Queue
 
 from libsked import database
 from libsked import pages
+from libsked import pageindex
 from libsked import options
 from libsked import xmlio
 from libsked import utils
 from libsked import macros
 from libsked import history
+from libsked import editdistance
+from libsked import records
+from libsked import markup
+from libsked import undo
 
 
 def remove_if_exists(fname):
     if os.path.exists(fname):
         os.remove(fname)
 
+def remove_database(fname):
+    # Removes a database file and its environment directory.
+    remove_if_exists(fname)
+    database._remove_env_dir(fname + ".env")
+
 
 class BaseSkedTestCase(unittest.TestCase):
     DB_NAME = "./test1.db"
@@ -40,6 +55,17 @@ class PageTestCase(BaseSkedTestCase):
         self.assertEquals(p.name, "teste", "Failed to set name")
         self.assertEquals(p.text, "peste", "Failed to set text")
 
+    def test_text_hash(self):
+        p = pages.Page(u"Name", u"Text")
+        digest = p.text_hash()
+        p.text = u"Text"
+        p.name = u"Other"
+        p.cursor_pos = 2
+        self.assertEquals(p.text_hash(), digest)
+        p.text = u"Other"
+        self.assertNotEquals(p.text_hash(), digest)
+        self.assertEquals(p.clone().text_hash(), p.text_hash())
+
     def test_cursor_pos_change_ascii(self):
         p = pages.Page()
         p.name = "Bazinga!"
@@ -92,7 +118,10 @@ class PageTestCase(BaseSkedTestCase):
 class DatabaseLowLevelTestCase(BaseSkedTestCase):
 
     def setUp(self):
-        remove_if_exists(self.DB_NAME)
+        remove_database(self.DB_NAME)
+
+    def tearDown(self):
+        remove_database(self.DB_NAME)
 
     def test_hash_functions(self):
         self.assertEquals(database.hash_sha256_str(""), 
@@ -166,7 +195,7 @@ class DatabaseLowLevelTestCase(BaseSkedTestCase):
 class BaseDBAccessTestCase(BaseSkedTestCase):
 
     def setUp(self):
-        remove_if_exists(self.DB_NAME)
+        remove_database(self.DB_NAME)
         self.db = database.EncryptedDatabase(self.DB_NAME)
         if not self.db.get_lock():
             raise Exception("Failed to get lock")
@@ -179,7 +208,7 @@ class BaseDBAccessTestCase(BaseSkedTestCase):
     def tearDown(self):
         self.db.close()
         self.db.release_lock()
-        remove_if_exists(self.DB_NAME)
+        remove_database(self.DB_NAME)
 
 
 class DatabaseAccessTestCase(BaseDBAccessTestCase):
@@ -201,6 +230,91 @@ class DatabaseAccessTestCase(BaseDBAccessTestCase):
             self.assertEquals(nv, v, "Corrupted data")
         self.db.sync()
 
+    def test_group_commit_reopen(self):
+        for x in range(0, 3000):
+            self.db.set_key(str(x), str(x), False)
+        self.db.del_key("42")
+        self.db.close()
+        self.assertEquals(self.db.get_lock(), True, "Failed to re-get lock")
+        self.assertEquals(self.db.try_open(self.PASSWORD), True,
+            "Failed to reopen the database")
+        self.assertEquals(self.db.get_key("42"), None)
+        for x in range(0, 3000):
+            if x != 42:
+                self.assertEquals(self.db.get_key(str(x)), str(x))
+
+    def test_durability(self):
+        for mode in (self.db.DURABILITY_NOSYNC, self.db.DURABILITY_WRITE_NOSYNC,
+        self.db.DURABILITY_SYNC):
+            self.db.durability = mode
+            self.assertEquals(self.db.durability, mode)
+            self.db.set_key("mode", mode)
+            self.assertEquals(self.db.get_key("mode"), mode)
+
+    def test_sync_policies(self):
+        self.db.sync_interval = 3600
+        self.db.sync_policy = self.db.SYNC_ALWAYS
+        self.db.set_key("a", 1)
+        self.assertEquals(self.db.is_dirty, False)
+        self.db.sync_policy = self.db.SYNC_INTERVAL
+        self.db.set_key("a", 2)
+        self.assertEquals(self.db.is_dirty, True)
+        self.db.sync_interval = 0
+        self.db.set_key("a", 3)
+        self.assertEquals(self.db.is_dirty, False)
+        self.db.sync_policy = self.db.SYNC_ON_IDLE
+        self.db.set_key("a", 4)
+        self.assertEquals(self.db.is_dirty, True)
+        self.assertEquals(self.db.get_key("a"), 4)
+        self.db.sync(True)
+        self.assertEquals(self.db.is_dirty, False)
+        self.db.sync_policy = self.db.SYNC_ON_QUIT
+        self.db.set_key("a", 5)
+        self.db.sync()
+        self.assertEquals(self.db.is_dirty, True)
+        self.assertRaises(ValueError, setattr, self.db, "sync_policy", "x")
+        self.db.close()
+        self.assertEquals(self.db.get_lock(), True)
+        self.assertEquals(self.db.try_open(self.PASSWORD), True)
+        self.assertEquals(self.db.get_key("a"), 5)
+
+    def test_legacy_records(self):
+        self.db._db.put("old", zlib.compress(cPickle.dumps({ "a": 1 }, 2)),
+            txn=self.db._write_txn())
+        self.assertEquals(self.db.get_key("old"), { "a": 1 })
+        self.db.compression_level = 0
+        self.db.set_key("new", "x" * 1000)
+        self.assertEquals(self.db.get_key("new"), "x" * 1000)
+
+    def test_batch(self):
+        self.db.begin_batch()
+        self.db.set_key("a", 1)
+        self.db.begin_batch()
+        self.db.set_key("b", 2)
+        self.db.commit()
+        self.assertEquals(self.db.get_key("b"), 2)
+        self.db.commit()
+        self.assertEquals(self.db.get_key("a"), 1)
+        with self.db.batch():
+            self.db.set_key("c", 3)
+        self.assertEquals(self.db.get_key("c"), 3)
+
+    def test_batch_abort(self):
+        self.db.set_key("a", 1, False)
+        self.db.begin_batch()
+        self.db.set_key("a", 2)
+        self.db.set_key("b", 2)
+        self.db.abort()
+        self.assertEquals(self.db.get_key("a"), 1)
+        self.assertEquals(self.db.get_key("b"), None)
+        try:
+            with self.db.batch():
+                self.db.set_key("c", 3)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEquals(self.db.has_key("c"), False)
+
     def test_change_password(self):
         new_password = "blerg"
         for x in range(0, 200):
@@ -238,6 +352,22 @@ class DatabaseAccessTestCase(BaseDBAccessTestCase):
             self.assertEquals(kv[1], "nothing", "Corrupted data")
         self.assertEquals(len(newkeys), len(keys), "Missing pairs")
 
+    def test_iterate_pairs_bulk(self):
+        for x in range(0, 500):
+            self.db.set_key("k%03d" % x, "x" * x, False)
+        self.db.sync()
+        bulk_size = database.EncryptedDatabase.BULK_READ_SIZE
+        database.EncryptedDatabase.BULK_READ_SIZE = 1000
+        try:
+            pairs = list(self.db.pairs("k"))
+            # The database may be written while iterated.
+            for key, value in self.db.pairs("k"):
+                self.db.set_key(key, value[1:], False)
+        finally:
+            database.EncryptedDatabase.BULK_READ_SIZE = bulk_size
+        self.assertEquals(pairs, [ ("k%03d" % x, "x" * x) for x in range(0, 500) ])
+        self.assertEquals(self.db.get_key("k499"), "x" * 498)
+
     def test_iterate_keys(self):
         keys = [ ]
         for x in range(0, 200):
@@ -249,6 +379,43 @@ class DatabaseAccessTestCase(BaseDBAccessTestCase):
             newkeys.append(k)
         self.assertEquals(len(newkeys), len(keys), "Missing keys")
 
+    def _check_key_ranges(self):
+        for x in range(0, 100):
+            self.db.set_key("a:%02d" % x, x, False)
+            self.db.set_key("b:%02d" % x, x, False)
+        self.db.sync()
+        keys = sorted(self.db.keys("a:"))
+        self.assertEquals(keys, [ "a:%02d" % x for x in range(0, 100) ])
+        pairs = sorted(self.db.pairs("b:", "b:10", "b:20"))
+        self.assertEquals(pairs, [ ("b:%02d" % x, x) for x in range(10, 20) ])
+        self.assertEquals(list(self.db.keys("c:")), [ ])
+        self.assertEquals(len(list(self.db.keys(start="b:50"))), 50)
+
+    def test_key_ranges(self):
+        self.assertEquals(self.db.is_sorted, True)
+        self._check_key_ranges()
+
+    def test_key_ranges_hash(self):
+        self.db.close()
+        remove_if_exists(self.DB_NAME)
+        self.db.get_lock()
+        self.db.create(self.PASSWORD, self.db.ACCESS_HASH)
+        self.assertEquals(self.db.is_sorted, False)
+        self._check_key_ranges()
+
+    def test_convert(self):
+        self.db.close()
+        remove_if_exists(self.DB_NAME)
+        self.db.get_lock()
+        self.db.create(self.PASSWORD, self.db.ACCESS_HASH)
+        for x in range(0, 200):
+            self.db.set_key(str(x), str(x))
+        self.assertEquals(self.db.convert(self.PASSWORD, self.db.ACCESS_BTREE),
+            True)
+        self.assertEquals(self.db.access_method, self.db.ACCESS_BTREE)
+        for x in range(0, 200):
+            self.assertEquals(self.db.get_key(str(x)), str(x))
+
     def test_complex_object_serialization(self):
         x1 = ( 1, 2, 3, "test", u"€1,99", None, True )
         x2 = [ 1, 2, 3, "test", u"€1,99", None, True ]
@@ -264,6 +431,155 @@ class DatabaseAccessTestCase(BaseDBAccessTestCase):
         self.assertEquals(self.db.get_key("x4"), x4)
 
 
+class AsyncDatabaseTestCase(BaseDBAccessTestCase):
+
+    def setUp(self):
+        BaseDBAccessTestCase.setUp(self)
+        self.adb = database.AsyncDatabase(self.db)
+
+    def tearDown(self):
+        self.adb.close()
+        remove_database(self.DB_NAME)
+
+    def _block_worker(self):
+        # Keeps the worker busy until the returned event is set.
+        event = threading.Event()
+        self.adb._submit(self.adb._WRITE, event.wait, ())
+        return event
+
+    def test_read_write(self):
+        for x in range(0, 500):
+            self.adb.set_key(str(x), str(x), False)
+        self.adb.sync()
+        for x in range(0, 500):
+            self.assertEquals(self.adb.get_key(str(x)), str(x))
+        self.adb.del_key("42")
+        self.assertEquals(self.adb.has_key("42"), False)
+        self.assertEquals(self.adb.get_key("42", "none"), "none")
+        self.adb.flush()
+        self.assertEquals(self.db.get_key("499"), "499")
+        self.assertEquals(self.db.has_key("42"), False)
+
+    def test_pending_reads(self):
+        self.adb.set_key("a", 1)
+        event = self._block_worker()
+        try:
+            self.adb.set_key("a", [ 1, 2 ])
+            self.adb.set_key("b", 2)
+            self.adb.del_key("c")
+            self.assertEquals(self.adb.get_key("a"), [ 1, 2 ])
+            self.assertEquals(self.adb.get_key_async("b").result(), 2)
+            self.assertEquals(self.adb.has_key("c"), False)
+            future = self.adb.get_key_async("d", "none")
+            self.assertEquals(future.done(), False)
+        finally:
+            event.set()
+        self.assertEquals(future.result(), "none")
+        self.adb.flush()
+        self.assertEquals(self.db.get_key("a"), [ 1, 2 ])
+
+    def test_batch(self):
+        with self.adb.batch():
+            self.adb.set_key("a", 1)
+        try:
+            with self.adb.batch():
+                self.adb.set_key("b", 2)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEquals(self.adb.get_key("a"), 1)
+        self.assertEquals(self.adb.get_key("b"), None)
+        self.assertEquals(list(self.adb.keys()), [ "a" ])
+
+    def test_write_error(self):
+        self.adb.set_record(42, "not a string key")
+        self.assertRaises(TypeError, self.adb.flush)
+        self.adb.set_key("a", 1)
+        self.adb.flush()
+
+    def test_batch_write_error(self):
+        self.adb.set_key("a", 1)
+        try:
+            with self.adb.batch():
+                self.adb.set_key("b", 2)
+                self.adb.set_record(42, "not a string key")
+        except TypeError:
+            pass
+        else:
+            self.fail("Write error not raised")
+        # The batch was aborted, so the later writes are not lost.
+        self.adb.set_key("c", 3)
+        self.adb.close()
+        self.db = database.EncryptedDatabase(self.DB_NAME)
+        self.assertEquals(self.db.get_lock(), True)
+        self.assertEquals(self.db.try_open(self.PASSWORD), True)
+        self.adb = database.AsyncDatabase(self.db)
+        self.assertEquals(sorted(self.adb.keys()), [ "a", "c" ])
+
+    def test_page_manager(self):
+        pm = pages.PageManager(self.adb)
+        pm.keep_revisions = True
+        pm.save(pages.Page(u"Acre", u"first text"))
+        self.assertEquals(len(pm.search(u"first", full_text=True)), 1)
+        page = pm.load(u"Acre")
+        # Saving a loaded page and loading it again must not wait for the
+        # worker.
+        event = self._block_worker()
+        timer = threading.Timer(5, event.set)
+        timer.start()
+        try:
+            start = time.time()
+            page.text = u"second text"
+            page.cursor_pos = 3
+            self.assertEquals(pm.save(page, False), True)
+            self.assertEquals(pm.get_meta(u"acre")["size"], 11)
+            loaded = [ ]
+            pm.load_async(u"acre", loaded.append, None)
+            self.assertEquals(loaded[0].text, u"second text")
+            self.assertEquals(loaded[0].cursor_pos, 3)
+            self.assertEquals(time.time() - start < 4, True)
+        finally:
+            event.set()
+            timer.cancel()
+        self.assertEquals([ rev[0] for rev in pm.list_revisions(u"Acre") ],
+            [ 1, 2 ])
+        self.assertEquals([ p.name for p in
+            pm.search(u"second", full_text=True) ], [ u"Acre" ])
+        self.assertEquals(pm.search(u"first", full_text=True), set())
+
+        # Pages not in memory are read by the worker.
+        pm = pages.PageManager(self.adb)
+        self.assertEquals(pm.exists(u"Acre"), True)
+        calls = Queue.Queue()
+        loaded = [ ]
+        event = self._block_worker()
+        try:
+            pm.load_async(u"Acre", loaded.append,
+                lambda func, *args: calls.put((func, args)))
+            self.assertEquals(loaded, [ ])
+        finally:
+            event.set()
+        func, args = calls.get(timeout=5)
+        func(*args)
+        self.assertEquals(loaded[0].text, u"second text")
+        self.assertEquals(loaded[0].cursor_pos, 3)
+        pm.load_async(u"Missing", loaded.append, None)
+        self.assertEquals(loaded[1], None)
+
+    def test_close_flushes(self):
+        pm = pages.PageManager(self.adb)
+        pm.save_many([ pages.Page("page %d" % i, "text %d" % i)
+            for i in range(0, 100) ])
+        self.adb.close()
+        self.db = database.EncryptedDatabase(self.DB_NAME)
+        self.assertEquals(self.db.get_lock(), True)
+        self.assertEquals(self.db.try_open(self.PASSWORD), True)
+        self.adb = database.AsyncDatabase(self.db)
+        pm = pages.PageManager(self.adb)
+        self.assertEquals(len(list(pm.iterate_names())), 100)
+        self.assertEquals(pm.load("page 42").text, "text 42")
+
+
 class OptionsTestCase(BaseDBAccessTestCase):
     
     def test_basic_operations(self):
@@ -416,6 +732,25 @@ class PageManagerTestCase(BasePMTestCase):
     def test_not_exists(self):
         self.assertEquals(self.pm.exists("Acre"), False)
 
+    def test_exists_updates(self):
+        self.assertEquals(self.pm.exists(u"31/12/2010"), False)
+        self.pm.save(pages.Page(u"2010-12-31", u"blerg"))
+        self.assertEquals(self.pm.exists(u"31/12/2010"), True)
+        self.assertEquals(pages.PageManager(self.db).exists(u"2010-12-31"),
+            True)
+        self.pm.delete(u"31/12/2010")
+        self.assertEquals(self.pm.exists(u"2010-12-31"), False)
+
+    def test_names_generation(self):
+        gen = self.pm.names_generation
+        self.pm.save(pages.Page(u"Acre", u"blerg"))
+        self.assertNotEquals(self.pm.names_generation, gen)
+        gen = self.pm.names_generation
+        self.pm.save(pages.Page(u"Acre", u"blergh"))
+        self.assertEquals(self.pm.names_generation, gen)
+        self.pm.delete(u"Acre")
+        self.assertNotEquals(self.pm.names_generation, gen)
+
     def test_page_load_many(self):
         pages = _make_some_pages()
         for p in pages:
@@ -440,6 +775,143 @@ class PageManagerTestCase(BasePMTestCase):
         for p in self.pm.iterate():
             self.assert_("Delete failed. No pages were expected here")
 
+    def test_page_save_many_batch(self):
+        pagelist = _make_some_pages()
+        self.pm.save_many(pagelist)
+        for p in pagelist:
+            np = self.pm.load(p.name)
+            self.assertNotEquals(np, None, "failed to load page")
+            self.assertEquals(np.text, p.text, "corrupted page text")
+        res = self.pm.search(u"nº99", self.pm.SEARCH_ALL, False, False,
+            True, None)
+        self.assertEquals(len(res), 11, str(res))
+        self.pm.delete_many([ p.name for p in pagelist[3:] ])
+        self.assertEquals(sorted(self.pm.iterate_names()), [ u"a", u"b", u"c" ])
+        res = self.pm.search(u"nº99", self.pm.SEARCH_ALL, False, False,
+            True, None)
+        self.assertEquals(len(res), 0, str(res))
+
+    def test_page_meta(self):
+        p = pages.Page(u"Ação", u"Até mais")
+        p.cursor_pos = 2
+        self.pm.save(p)
+        meta = self.pm.get_meta(u"AÇÃO")
+        self.assertEquals(meta["name"], u"Ação")
+        self.assertEquals(meta["size"], 9)
+        self.assertNotEquals(meta["created"], None)
+        p.cursor_pos = 0
+        self.pm.save(p)
+        self.assertEquals(self.pm.get_meta(u"Ação")["hash"], meta["hash"])
+        p.text = u"Outro texto"
+        self.pm.save(p)
+        self.assertNotEquals(self.pm.get_meta(u"Ação")["hash"], meta["hash"])
+        self.assertEquals(self.pm.get_meta(u"Ação")["created"], meta["created"])
+        self.assertEquals([ name for name, meta in self.pm.iterate_meta() ],
+            [ u"ação" ])
+        self.pm.delete(u"Ação")
+        self.assertEquals(self.pm.get_meta(u"Ação"), None)
+
+    def test_page_save_unchanged(self):
+        p = pages.Page(u"Page", u"Some text")
+        self.assertEquals(self.pm.save(p), True)
+        writes = [ ]
+        set_key = self.db.set_key
+        def counting_set_key(key, value, sync = True):
+            writes.append(key)
+            set_key(key, value, sync)
+        self.db.set_key = counting_set_key
+        try:
+            self.assertEquals(self.pm.save(p), False)
+            self.assertEquals(self.pm.save(pages.Page(u"Page", u"Some text")),
+                False)
+            self.assertEquals(self.pm.save(self.pm.load(u"page")), False)
+            self.assertEquals(writes, [ ])
+            p.cursor_pos = 4
+            self.assertEquals(self.pm.save(p), True)
+            self.assertEquals(self.pm.load(u"Page").cursor_pos, 4)
+            self.assertEquals(writes, [ "pagepos:page" ])
+            p.name = u"PAGE"
+            self.assertEquals(self.pm.save(p), True)
+            self.assertEquals(self.pm.load(u"Page").name, u"PAGE")
+            self.assertEquals(self.pm.save(pages.Page(u"Missing", u"")),
+                False)
+        finally:
+            del self.db.set_key
+
+    def test_page_positions(self):
+        p = pages.Page(u"Page", u"Some longer text")
+        p.cursor_pos = 3
+        self.pm.save(p)
+        self.assertEquals(self.pm.load(u"Page").cursor_pos, 3)
+        self.assertEquals(self.pm.load(u"Page").scroll_pos, None)
+        p.cursor_pos = 5
+        p.scroll_pos = 2
+        self.pm.save(p)
+        self.pm.cache.clear()
+        p = pages.PageManager(self.db).load(u"Page")
+        self.assertEquals((p.cursor_pos, p.scroll_pos), (5, 2))
+        p.text = u"Short"
+        self.pm.save(p)
+        p = self.pm.load(u"Page")
+        self.assertEquals((p.text, p.cursor_pos, p.scroll_pos),
+            (u"Short", 5, 2))
+        self.pm.delete(u"Page")
+        self.assertEquals(self.db.has_key("pagepos:page"), False)
+
+    def test_page_meta_rebuild(self):
+        self.pm.save(pages.Page(u"3/2/1983", u"Text"))
+        self.pm.save(pages.Page(u"Other", u"Text"))
+        created = self.pm.get_meta(u"Other")["created"]
+        self.pm.rebuild_index()
+        pm2 = pages.PageManager(self.db)
+        self.assertEquals(pm2.get_meta(u"1983-02-03")["name"], u"3/2/1983")
+        self.assertEquals(pm2.get_meta(u"Other")["created"], created)
+
+    def test_month_days(self):
+        for name in [ u"3/2/2010", u"2010-02-28", u"1/3/2010", u"31/1/2010",
+        u"2010-02-xyz", u"Other" ]:
+            self.pm.save(pages.Page(name, u"text"))
+        self.assertEquals(self.pm.month_days(2010, 2), set([ 3, 28 ]))
+        self.assertEquals(self.pm.month_days(2010, 1), set([ 31 ]))
+        self.assertEquals(self.pm.month_days(2011, 1), set())
+        self.assertEquals(self.pm.year_days(2010), { 1: set([ 31 ]),
+            2: set([ 3, 28 ]), 3: set([ 1 ]) })
+        self.pm.delete(u"2010-02-03")
+        self.pm.delete(u"2010-01-31")
+        self.assertEquals(self.pm.year_days(2010), { 2: set([ 28 ]),
+            3: set([ 1 ]) })
+        self.pm.save(pages.Page(u"4/1/2011", u"text"))
+        self.assertEquals(pages.PageManager(self.db).month_days(2011, 1),
+            set([ 4 ]))
+
+    def test_page_cache(self):
+        self.pm.save(pages.Page(u"Cached", u"Some text"))
+        self.pm.cache.clear()
+        p1 = self.pm.load(u"Cached")
+        self.assertEquals(self.pm.cache.misses, 1)
+        p1.text = u"Changed, but not saved"
+        p2 = self.pm.load(u"CACHED")
+        self.assertEquals(self.pm.cache.hits, 1)
+        self.assertEquals(p2.text, u"Some text")
+        p2.text = u"Saved"
+        self.pm.save(p2)
+        self.assertEquals(self.pm.load(u"Cached").text, u"Saved")
+        self.pm.delete(u"Cached")
+        self.assertEquals(self.pm.load(u"Cached"), None)
+
+    def test_page_cache_limit(self):
+        cache = pages.PageCache(100000)
+        for i in range(0, 1000):
+            cache.put(str(i), pages.Page(str(i), u"x" * 100))
+        self.assert_(cache.size <= cache.max_size)
+        self.assertEquals(cache.get("0"), None)
+        self.assertEquals(cache.get("999").text, u"x" * 100)
+        first = min([ int(k) for k in range(0, 1000) if str(k) in cache ])
+        cache.get(str(first))
+        cache.put("new", pages.Page("new", u"x" * 100))
+        self.assert_(str(first) in cache)
+        self.assert_(str(first + 1) not in cache)
+
     def test_iterate(self):
         pages = _make_some_pages()
         for p in pages:
@@ -565,6 +1037,88 @@ class SearchTestCase(BasePMTestCase):
         self.pm.search(u"ni!", self.pm.SEARCH_ANY, False, False, False, retlist.append)
         self.assertEquals(len(retlist), 3, "Failed search with callbacks")
 
+        for terms, mode in [ (u"test", self.pm.SEARCH_ALL),
+        (u"NotHinG NoNe", self.pm.SEARCH_ANY),
+        (u"Ni! Ni!", self.pm.SEARCH_EXACT), (u"úscULas", self.pm.SEARCH_ALL) ]:
+            res = self.pm.search(terms, mode)
+            self.assertEquals(sorted(self.pm.search_names(terms, mode)),
+                sorted([ p.name for p in res ]))
+        self.assertEquals(self.pm.search_names(u"Ni!"),
+            [ u"Bar Ni! Ni!", u"Baz Ni! Ni! Ni!", u"Foo Ni!" ])
+
+    def test_search_index_updates(self):
+        self.pm.save(pages.Page(u"Foo", u"alpha beta"))
+        self.pm.save(pages.Page(u"Bar", u"beta gamma"))
+        res = self.pm.search(u"beta", self.pm.SEARCH_ALL, False, True, True, None)
+        self.assertEquals(len(res), 2, str(res))
+        self.pm.save(pages.Page(u"Foo", u"delta"))
+        res = self.pm.search(u"beta", self.pm.SEARCH_ALL, False, True, True, None)
+        self.assertEquals(len(res), 1, str(res))
+        res = self.pm.search(u"elt", self.pm.SEARCH_ALL, False, True, True, None)
+        self.assertEquals(len(res), 1, str(res))
+        self.pm.delete(u"Bar")
+        res = self.pm.search(u"beta gamma", self.pm.SEARCH_ANY, False, True, True, None)
+        self.assertEquals(len(res), 0, str(res))
+
+    def test_search_index_rebuild(self):
+        self.pm.save(pages.Page(u"Foo", u"alpha beta"))
+        self.pm.save(pages.Page(u"Bar", u"beta gamma"))
+        self.pm.rebuild_index()
+        pm2 = pages.PageManager(self.db)
+        res = pm2.search(u"gamma", self.pm.SEARCH_EXACT, False, True, True, None)
+        self.assertEquals(len(res), 1, str(res))
+
+    def test_search_names_substring(self):
+        self.pm.save(pages.Page(u"Meeting 13/02/2010", u"agenda"))
+        self.pm.save(pages.Page(u"Shopping list", u"eggs"))
+        self.pm.save(pages.Page(u"Old list", u"milk"))
+        res = self.pm.search(u"13/02", self.pm.SEARCH_EXACT, False, False, True, None)
+        self.assertEquals([ p.name for p in res ], [ u"Meeting 13/02/2010" ])
+        res = self.pm.search(u"IST", self.pm.SEARCH_ALL, False, False, True, None)
+        self.assertEquals(len(res), 2, str(res))
+        self.assertEquals(self.db.has_key("ftindex"), False)
+        self.pm.delete(u"Old list")
+        pm2 = pages.PageManager(self.db)
+        res = pm2.search(u"list", self.pm.SEARCH_ANY, False, False, True, None)
+        self.assertEquals(len(res), 1, str(res))
+
+    def test_search_names_short_terms(self):
+        for i in range(0, 30):
+            self.pm.save(pages.Page(u"Page %d" % i, u"text %d" % i))
+        pm = pages.PageManager(self.db)
+        loads = [ ]
+        get_key = self.db.get_key
+        def counting_get_key(key, default = None):
+            if key.startswith(pages.PageManager._PREFIX):
+                loads.append(key)
+            return get_key(key, default)
+        self.db.get_key = counting_get_key
+        try:
+            # Terms shorter than a trigram are matched from the names.
+            names = pm.search_names(u"e 1")
+        finally:
+            del self.db.get_key
+        self.assertEquals(names, [ u"Page 1" ] +
+            [ u"Page %d" % i for i in range(10, 20) ] + [ u"Page 21" ])
+        self.assertEquals(loads, [ ])
+        self.assertEquals(self.db.has_key("ftindex"), False)
+
+    def test_full_text_rebuild_interrupted(self):
+        for i in range(0, 10):
+            self.pm.save(pages.Page(u"Page %d" % i, u"word%d" % i))
+        self.assertEquals(len(self.pm.search(u"word", full_text=True)), 10)
+        def interrupted():
+            for page in self.pm.iterate():
+                if page.name == u"Page 5":
+                    raise KeyboardInterrupt
+                yield page
+        fts = pageindex.FullTextIndex(self.db)
+        fts.FLUSH_INTERVAL = 2
+        self.assertRaises(KeyboardInterrupt, fts.rebuild, interrupted())
+        self.assertEquals(self.db.has_key("ftindex"), False)
+        pm = pages.PageManager(self.db)
+        self.assertEquals(len(pm.search(u"word", full_text=True)), 10)
+
     def test_search_levenshtein(self):
         self.pm.save(pages.Page(u"Levenshtein xxxxxxx", u"No text"))
         self.pm.save(pages.Page(u"Levenshtein xxxxxx.", u"No text"))
@@ -581,15 +1135,95 @@ class SearchTestCase(BasePMTestCase):
         self.assertEquals(results[2], u"Levenshtein xxxxx..", "Levenshtein search failed (3)")
         self.assertEquals(results[3], u"Levenshtein xxxx...", "Levenshtein search failed (4)")
 
+    def test_search_levenshtein_names(self):
+        self.pm.save(pages.Page(u"Levenshtein xxxxxxx", u"No text"))
+        self.pm.save(pages.Page(u"LEVENSHTEIN xxxxxx.", u"No text"))
+        self.pm.save(pages.Page(u"3/2/1983", u"No text"))
+        results = self.pm.levenshtein_search("levenshtein xxxxxx.", 2)
+        self.assertEquals(results, [ u"LEVENSHTEIN xxxxxx.",
+            u"Levenshtein xxxxxxx" ])
+        self.pm.delete(u"levenshtein xxxxxx.")
+        pm2 = pages.PageManager(self.db)
+        results = pm2.levenshtein_search("1983-02-03", 1)
+        self.assertEquals(results, [ u"3/2/1983" ])
+        results = pm2.levenshtein_search("levenshtein xxxxxx.", 5)
+        self.assertEquals(len(results), 2, str(results))
+
+
+
+class RevisionsTestCase(BasePMTestCase):
+
+    def _texts(self, count):
+        rnd = random.Random(11)
+        texts = [ u"First version.\n" ]
+        for i in range(count - 1):
+            text = texts[-1]
+            pos = rnd.randint(0, len(text))
+            texts.append(text[:pos] + rnd.choice([ u"a", u"bc\n", u"" ]) +
+                text[pos + rnd.randint(0, 3):] + u"\n%d" % i)
+        return texts
+
+    def test_add_get(self):
+        log = self.pm.revisions
+        texts = self._texts(100)
+        for i, text in enumerate(texts):
+            log.add("page", text, 1000 + i)
+        log.add("page", texts[-1], 2000)
+        self.assertEquals(log.list("page"),
+            [ (i + 1, 1000 + i) for i in range(100) ])
+        for i, text in enumerate(texts):
+            self.assertEquals(log.get("page", i + 1), text)
+        self.assertEquals(log.get("page", 101), None)
+        self.assertEquals(log.get("other", 1), None)
+        full = [ rev for rev in self.db.get_key("pagerevs:page") if rev[2] ]
+        self.assertEquals(len(full), 4)
+
+    def test_prune(self):
+        log = self.pm.revisions
+        log.max_count = 50
+        log.max_age = 1000
+        texts = self._texts(100)
+        for i, text in enumerate(texts):
+            log.add("page", text, 1000 + i)
+        self.assertEquals([ rev[0] for rev in log.list("page") ],
+            range(51, 101))
+        for i in range(50, 100):
+            self.assertEquals(log.get("page", i + 1), texts[i])
+        self.assertEquals(self.db.get_key(log._key("page", 50)), None)
+        log.add("page", u"New", 2080)
+        self.assertEquals([ rev[0] for rev in log.list("page") ],
+            range(81, 102))
+        self.assertEquals(log.get("page", 81), texts[80])
+        log.add("page", u"Newer", 5000)
+        self.assertEquals(log.list("page"), [ (102, 5000) ])
+        log.remove("page")
+        self.assertEquals(log.list("page"), [ ])
+        self.assertEquals(self.db.get_key(log._key("page", 102)), None)
+
+    def test_page_revisions(self):
+        self.pm.save(pages.Page(u"Acre", u"zero"))
+        self.assertEquals(self.pm.list_revisions(u"Acre"), [ ])
+        self.pm.keep_revisions = True
+        for text in [ u"one", u"two", u"two", u"three" ]:
+            self.pm.save(pages.Page(u"Acre", text))
+        revs = self.pm.list_revisions(u"acre")
+        self.assertEquals([ rev[0] for rev in revs ], [ 1, 2, 3 ])
+        self.assertEquals(self.pm.load_revision(u"Acre", 2).text, u"two")
+        self.assertEquals(self.pm.load_revision(u"Acre", 4), None)
+        page = self.pm.restore_revision(u"Acre", 1)
+        self.assertEquals(page.name, u"Acre")
+        self.assertEquals(self.pm.load(u"Acre").text, u"one")
+        self.assertEquals(len(self.pm.list_revisions(u"Acre")), 4)
+        self.pm.delete(u"Acre")
+        self.assertEquals(self.pm.list_revisions(u"Acre"), [ ])
 
 
 class XmlIOTestCase(BasePMTestCase):
 
     def tearDown(self):
         BasePMTestCase.tearDown(self)
-        remove_if_exists(self.DB_NAME)
         remove_if_exists(self.XML_FNAME)
-        remove_if_exists(self.OTHER_DB_NAME)
+        remove_database(self.OTHER_DB_NAME)
 
     def test_xml_export(self):
         pages = _make_some_pages()
@@ -601,6 +1235,29 @@ class XmlIOTestCase(BasePMTestCase):
         self.test_xml_export()
         xmlio.import_xml_file(self.XML_FNAME, self.db, self.pm, None, None)
 
+    def test_xml_import_error(self):
+        pagelist = _make_some_pages()
+        self.pm.save_many(pagelist)
+        xmlio.export_xml_file(self.XML_FNAME, self.pm, None, None)
+        self.pm.delete_many([ p.name for p in pagelist ])
+        fp = open(self.XML_FNAME, "rb")
+        data = fp.read()
+        fp.close()
+        fp = open(self.XML_FNAME, "wb")
+        fp.write(data[:data.rindex("</skeddata>")])
+        fp.close()
+        bufsize = xmlio.SkedContentHandler.PAGE_BUFFER_SIZE
+        xmlio.SkedContentHandler.PAGE_BUFFER_SIZE = 1
+        try:
+            self.assertRaises(Exception, xmlio.import_xml_file,
+                self.XML_FNAME, self.db, self.pm, None, None)
+        finally:
+            xmlio.SkedContentHandler.PAGE_BUFFER_SIZE = bufsize
+        for p in pagelist:
+            self.assertEquals(self.pm.exists(p.name), False)
+            self.assertEquals(self.pm.load(p.name), None)
+        self.assertEquals(list(self.pm.iterate_names()), [ ])
+
     def test_xml_roundtrip(self):
         pagelist = _make_some_pages()
         for p in pagelist:
@@ -654,6 +1311,278 @@ class XmlIOTestCase(BasePMTestCase):
 
 
 
+class EditDistanceTestCase(unittest.TestCase):
+
+    def _slow_distance(self, a, b):
+        row = range(len(b) + 1)
+        for i, ca in enumerate(a):
+            prev, row = row, [ i + 1 ]
+            for j, cb in enumerate(b):
+                row.append(min(prev[j+1] + 1, row[j] + 1,
+                    prev[j] + (ca != cb)))
+        return row[-1]
+
+    def _random_word(self, rnd, maxlen):
+        return u"".join([ rnd.choice(u"abcdeßã ")
+            for i in range(rnd.randint(0, maxlen)) ])
+
+    def test_myers_distance(self):
+        self.assertEquals(editdistance.myers_distance(u"", u""), 0)
+        self.assertEquals(editdistance.myers_distance(u"", u"abc"), 3)
+        self.assertEquals(editdistance.myers_distance(u"kitten", u"sitting"), 3)
+        self.assertEquals(editdistance.myers_distance(u"paßword", u"password"), 2)
+        rnd = random.Random(0)
+        for i in range(500):
+            a = self._random_word(rnd, 80)
+            b = self._random_word(rnd, 80)
+            self.assertEquals(editdistance.myers_distance(a, b),
+                self._slow_distance(a, b), repr((a, b)))
+
+    def test_batch_matcher(self):
+        rnd = random.Random(1)
+        words = set([ self._random_word(rnd, 30) for i in range(300) ])
+        bm = editdistance.BatchMatcher(words)
+        bm.add(u"some extra word")
+        bm.remove(u"some extra word")
+        self.assertEquals(len(bm), len(words))
+        have_numpy = editdistance.HAVE_NUMPY
+        try:
+            for term in [ u"", u"abc", u"ßßß", u"a" * 64, u"abcde" * 14 ]:
+                expected = sorted([ (self._slow_distance(term, w), w)
+                    for w in words ])[:10]
+                editdistance.HAVE_NUMPY = have_numpy
+                self.assertEquals(bm.nearest(term, 10), expected)
+                editdistance.HAVE_NUMPY = False
+                self.assertEquals(bm.nearest(term, 10), expected)
+        finally:
+            editdistance.HAVE_NUMPY = have_numpy
+
+
+class RecordsTestCase(unittest.TestCase):
+
+    def test_encode_decode(self):
+        for value in [ 1, "x", u"Até", { "a": [ 1, 2 ] }, set([ u"ab" ]),
+        "abc" * 1000, range(1000) ]:
+            rec = records.encode(value)
+            self.assertEquals(records.decode(rec), value)
+            self.assertEquals(records.decode(records.encode(value, 0)), value)
+        self.assertEquals(ord(records.encode(1)[0]),
+            records.PICKLE | records.RAW)
+        self.assertEquals(ord(records.encode("abc" * 1000)[0]),
+            records.PICKLE | records.ZLIB)
+
+    def test_legacy(self):
+        for value in [ 1, u"Até", (u"name", u"text", 3) ]:
+            rec = zlib.compress(cPickle.dumps(value, 2))
+            self.assertEquals(records.decode(rec), value)
+
+    def test_page_record(self):
+        text = u"Olá, [[Index]]! Back to the meeting.\n" * 20
+        for level in range(0, 10):
+            rec = records.encode(records.PageRecord(u"Até", text, 42), level)
+            page = records.decode(rec)
+            self.assertEquals(isinstance(page, records.PageRecord), True)
+            self.assertEquals(page, (u"Até".encode("utf-8"),
+                text.encode("utf-8"), 42))
+        self.assertEquals(ord(rec[0]), records.PAGE | records.ZDICT)
+        rec = records.encode(records.PageRecord("a", "", 0))
+        self.assertEquals(records.decode(rec), ("a", "", 0))
+
+    def test_preset_dictionary(self):
+        text = "Sked wiki language. Back to [[Sked Help]]\n"
+        pd = records.PresetDictionary(records.train_dictionary([ text ] * 5))
+        self.assertEquals(pd.decompress(pd.compress(text, 9)), text)
+        self.assertEquals(len(pd.compress(text)) < len(zlib.compress(text)),
+            True)
+
+
+class MarkupTestCase(unittest.TestCase):
+
+    def _kinds(self, text):
+        return [ (text[s[0]:s[1]], s[2], s[3]) for s in markup.parse(text) ]
+
+    def test_emphasis(self):
+        self.assertEquals(self._kinds(u"*bold*, //it// _u_"), [
+            (u"*", markup.FORMAT, None), (u"bold", markup.BOLD, None),
+            (u"*", markup.FORMAT, None), (u"//", markup.FORMAT, None),
+            (u"it", markup.ITALIC, None), (u"//", markup.FORMAT, None),
+            (u"_", markup.FORMAT, None), (u"u", markup.UNDERLINE, None),
+            (u"_", markup.FORMAT, None) ])
+        self.assertEquals(self._kinds(u"a*b* c_d_ 2*3*4"), [ ])
+
+    def test_headings(self):
+        spans = self._kinds(u"text\n\n=== One ===\n== *Two* ==\n= Three =")
+        self.assertEquals([ s for s in spans if s[1] != markup.FORMAT ], [
+            (u" One ", markup.H1, None), (u" *Two* ", markup.H2, None),
+            (u"Two", markup.BOLD, None), (u" Three ", markup.H3, None) ])
+        self.assertEquals(self._kinds(u"== Not ===\n==== Not ====\n"), [ ])
+
+    def test_links(self):
+        self.assertEquals(self._kinds(u"See [[ Some page ]] or www.a.com/x."),
+            [ (u"[[ ", markup.FORMAT, None),
+            (u"Some page", markup.LINK, u"Some page"),
+            (u" ]]", markup.FORMAT, None),
+            (u"www.a.com/x", markup.URL, u"www.a.com/x") ])
+        self.assertEquals(self._kinds(u"(http://ittner.com.br/sked)"),
+            [ (u"http://ittner.com.br/sked", markup.URL,
+            u"http://ittner.com.br/sked") ])
+
+    def test_dates(self):
+        self.assertEquals(self._kinds(u"On 3/4/2010 and 2010-5-06."), [
+            (u"3/4/2010", markup.DATE, u"2010-04-03"),
+            (u"2010-5-06", markup.DATE, u"2010-05-06") ])
+
+    def test_code(self):
+        text = u"*a*\n|||\n*not bold* [[No link]]\n|||\n*b*"
+        self.assertEquals([ s[1] for s in self._kinds(text) ], [
+            markup.FORMAT, markup.BOLD, markup.FORMAT,
+            markup.FORMAT, markup.CODE, markup.FORMAT,
+            markup.FORMAT, markup.BOLD, markup.FORMAT ])
+        self.assertEquals(markup.code_blocks(text), [ (4, 34) ])
+        self.assertEquals(markup.code_blocks(text, 4), [ ])
+        # Other markup may not hide the delimiters of a block.
+        text = u"[[a|||b]] *c|||* |||"
+        self.assertEquals(markup.code_blocks(text), [ (3, 15) ])
+        self.assertEquals(self._kinds(text), [
+            (u"|||", markup.FORMAT, None), (u"b]] *c", markup.CODE, None),
+            (u"|||", markup.FORMAT, None) ])
+
+    def test_region(self):
+        text = u"*a*\n//b// [[c]]\n_d_"
+        spans = markup.parse(text)
+        region = markup.parse(text, 4, 15)
+        self.assertEquals(region, [ s for s in spans if 4 <= s[0] < 15 ])
+        for i in range(len(spans) - 1):
+            self.assertEquals(spans[i][0] <= spans[i+1][0], True)
+
+    def test_expand_region(self):
+        text = u"== A ==\n*b* |||c\nd||| //e// |||f||| [[g]]\n_h_\n" * 300
+        blocks = markup.code_blocks(text)
+        self.assertEquals(markup.expand_region(blocks, text, 10, 14),
+            (8, 42))
+        self.assertEquals(markup.expand_region(blocks, text, 20, 30),
+            (8, 42))
+        self.assertEquals(markup.expand_region(blocks, text, 42, 44),
+            (42, 46))
+        # Chunks parsed apart give the same spans as the whole text.
+        spans = [ ]
+        pos = 0
+        while pos < len(text):
+            start, end = markup.expand_region(blocks, text, pos, pos + 25)
+            self.assertEquals(start, pos)
+            spans.extend(markup.parse(text, start, end))
+            pos = end
+        self.assertEquals(spans, markup.parse(text))
+
+    def test_span_cache(self):
+        cache = markup.SpanCache(5)
+        cache.put("a", [ 1, 2 ], 0)
+        cache.put("b", [ 3, 4 ], 0)
+        self.assertEquals(cache.get("a", 0), [ 1, 2 ])
+        cache.put("c", [ 5, 6 ], 0)     # Drops "b", the least recently used
+        self.assertEquals(cache.get("b", 0), None)
+        self.assertEquals(cache.get("a", 0), [ 1, 2 ])
+        self.assertEquals(cache.get("c", 0), [ 5, 6 ])
+        self.assertEquals(cache.size, 4)
+        cache.put("d", range(6), 0)     # Too large
+        self.assertEquals(cache.get("d", 0), None)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get("a", 1), None)
+        self.assertEquals(len(cache), 0)
+
+
+class UndoTestCase(unittest.TestCase):
+
+    def test_diff_patch(self):
+        rnd = random.Random(42)
+        text = u"".join([ rnd.choice(u"ab\n\u00e7") for i in range(5000) ])
+        for i in range(200):
+            pos = rnd.randint(0, len(text))
+            end = rnd.randint(pos, min(len(text), pos + 3000))
+            new = text[:pos] + u"x" * rnd.randint(0, 5) + text[end:]
+            delta = undo.diff(text, new)
+            self.assertEquals(undo.patch(text, delta), new)
+            self.assertEquals(undo.patch(new, (delta[0], delta[2], delta[1])),
+                text)
+            text = new
+        self.assertEquals(undo.diff(u"abc", u"abc"), (3, u"", u""))
+        self.assertEquals(undo.diff(u"aXa", u"aa"), (1, u"X", u""))
+
+    def _edit(self, urm, text, offset, removed, inserted):
+        # Edits the text as the text buffer would, recording the changes.
+        if removed > 0:
+            urm.delete(offset, text[offset:offset + removed])
+            text = text[:offset] + text[offset + removed:]
+        if len(inserted) > 0:
+            urm.insert(offset, inserted)
+            text = text[:offset] + inserted + text[offset:]
+        return text
+
+    def test_typing_groups(self):
+        urm = undo.UndoRedoManager()
+        self.assertEquals(urm.can_undo(), False)
+        text = u""
+        for char in u"Some words\n":
+            text = self._edit(urm, text, len(text), 0, char)
+        for i in range(6):     # Backspace
+            text = self._edit(urm, text, len(text) - 1, 1, u"")
+        self.assertEquals(text, u"Some ")
+        text = self._edit(urm, text, 0, 0, u"Pasted ")
+        self.assertEquals(urm.undo(), (0, u"Pasted ", u""))
+        self.assertEquals(urm.undo(), (5, u"", u"words"))
+        self.assertEquals(urm.undo(), (10, u"", u"\n"))
+        self.assertEquals(urm.undo(), (5, u"words\n", u""))
+        self.assertEquals(urm.undo(), (0, u"Some ", u""))
+        self.assertEquals(urm.can_undo(), False)
+        self.assertEquals(urm.redo(), (0, u"", u"Some "))
+        urm.insert(5, u"x")
+        self.assertEquals(urm.can_redo(), False)
+        urm.close_group()
+        urm.insert(6, u"y")
+        self.assertEquals(urm.undo(), (6, u"y", u""))
+
+    def test_undo_redo(self):
+        rnd = random.Random(7)
+        urm = undo.UndoRedoManager(100000)
+        texts = [ u"Some text." ]
+        for i in range(500):
+            text = texts[-1]
+            offset = rnd.randint(0, len(text))
+            if rnd.random() < 0.8:
+                removed = rnd.choice([ 0, 0, 1, 1, 5 ])
+                removed = min(removed, len(text) - offset)
+                inserted = rnd.choice([ u"", u"a", u" ", u"b\n", u"cde" ])
+            else:
+                removed = 0
+                inserted = rnd.choice(u"ab ")
+                offset = len(text)
+            texts.append(self._edit(urm, text, offset, removed, inserted))
+        text = texts[-1]
+        while urm.can_undo():
+            text = undo.patch(text, urm.undo())
+        self.assertEquals(text, texts[0])
+        while urm.can_redo():
+            text = undo.patch(text, urm.redo())
+        self.assertEquals(text, texts[-1])
+
+    def test_memory_limit(self):
+        urm = undo.UndoRedoManager(100, 50000)
+        original = text = u"Some text of a large page.\n" * 5000
+        for i in range(10):
+            text = self._edit(urm, text, i * 100, 5000, u"*")
+            self.assertEquals(urm.size() <= urm.max_bytes, True)
+        # The older changes are packed, but kept.
+        while urm.can_undo():
+            text = undo.patch(text, urm.undo())
+        self.assertEquals(text, original)
+        urm = undo.UndoRedoManager(100, 5000)
+        for i in range(10):
+            text = self._edit(urm, text, i * 100, 2000, u"*")
+            self.assertEquals(urm.size() <= urm.max_bytes, True)
+        self.assertEquals(urm.undo(), (900, u"*", u""))
+        self.assertEquals(len(urm.undo()[2]), 2000)
+
+
 class MacrosTestCase(BaseSkedTestCase):
     
     def test_evaluation_simple(self):